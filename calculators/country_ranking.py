@@ -3,10 +3,68 @@
 import logging
 from datetime import datetime
 
+import numpy as np
+from sqlalchemy import delete, insert, select, update
+
 from utils.scrapers import Country_Scraper
-from models import Player, Country, Ruleset, Settings
+from models import Player, Country, CountryRankHistory, Ruleset
+from calculators import ranking_numpy
 from calculators.ranking import PlayerRankingEngine
 
+RULESETS = tuple(Ruleset)
+
+# the countries are ranked by their best three players, and players who are
+# ranked over 700 count towards the quotas
+TOP = 3
+STRONG = 700
+
+
+def country_stats(snapshot, country_ids, player_countries) -> dict:
+    """ the country ranking for every ruleset, from one pass over the ranks
+    in a Snapshot.
+
+    country_ids lists the countries to rank, and player_countries gives the
+    index into country_ids of each player in snapshot.player_ids, or -1 if
+    their country isn't ranked. Only players with a position count.
+
+    Returns {ruleset: [(country_id, position, player_count, over700,
+    top3_average), ...]} in country_ids order. Countries without any players
+    have no position and no average """
+    stats = {}
+    count = len(country_ids)
+    for ruleset in RULESETS:
+        has_position = (snapshot.positions[ruleset] > 0) & \
+            (player_countries >= 0)
+        countries = player_countries[has_position]
+        ranks = snapshot.ranks[ruleset][has_position]
+        player_count = np.bincount(countries, minlength=count)
+        over700 = np.bincount(countries, weights=ranks > STRONG,
+                              minlength=count)
+
+        # best first within each country, then keep the top 3. bincount
+        # adds them up in that order, the same as sum() of the best three
+        order = np.lexsort((-ranks, countries))
+        countries = countries[order]
+        ranks = ranks[order]
+        first = np.searchsorted(countries, countries)
+        top = np.arange(len(countries)) - first < TOP
+        top3 = np.bincount(countries[top], weights=ranks[top],
+                           minlength=count)
+
+        averages = [round(float(top3[i]) / TOP, 2) if player_count[i] else
+                    None for i in range(count)]
+        # stable, so ties stay in country_ids order
+        ranked = sorted((i for i in range(count) if averages[i] is not None),
+                        key=lambda i: averages[i], reverse=True)
+        positions = [None] * count
+        for pos, i in enumerate(ranked, 1):
+            positions[i] = pos
+        stats[ruleset] = [
+            (country_ids[i], positions[i], int(player_count[i]),
+             int(over700[i]), averages[i]) for i in range(count)]
+    return stats
+
+
 class CountryRankingEngine:
     """ rank the countries
     for a given ruleset. The ranking is based on the average rank for the
@@ -15,107 +73,161 @@ class CountryRankingEngine:
     by 3"""
     def __init__(self, db):
         self.db = db
-
-    def rank_countries_for_one_ruleset(
+        self.country_ids = None
+        self.player_countries = None
+
+    def load_countries(self, player_ids):
+        """ the countries to rank, and which of them each player is from """
+        self.country_ids = list(self.db.scalars(select(Country.id).where(
+            Country.id != "??").order_by(Country.id)))
+        index = {c: i for i, c in enumerate(self.country_ids)}
+        countries = dict(self.db.execute(select(
+            Player.id, Player.country_id)).all())
+        self.player_countries = np.array(
+            [index.get(countries.get(p), -1) for p in player_ids],
+            dtype=np.int64)
+
+    def stats(self, snapshot) -> dict:
+        """ the country ranking for a Snapshot of the player ranking, e.g.
+        one day of PlayerRankingEngine.sweep(). Nothing is written """
+        if self.player_countries is None or \
+                len(self.player_countries) != len(snapshot.player_ids):
+            self.load_countries(snapshot.player_ids)
+        return country_stats(snapshot, self.country_ids,
+                             self.player_countries)
+
+    def rank_countries(
             self,
-            ruleset: Ruleset,
             write_to_db: bool = True,
             reckoning_day: datetime = None,
             assess: bool = False,
+            rulesets=RULESETS,
             ):
-
+        """ rank the countries for both rulesets from the player ranks in
+        the database, re-ranking the players first if reckoning_day is
+        given """
         if reckoning_day is not None:
             PlayerRankingEngine(self.db).rank_all_players(reckoning_day)
 
-        ema = [] # list of ema countries
-        is_mcr = ruleset == Ruleset.mcr
-        rules = str(ruleset).replace("Ruleset.", "")
-
-        # find all players that have a valid rank for this ruleset, and
-        # list them in descending rank order
-        all_players = self.db.query(Player).filter(
-            Player.ema_id != -1).filter(
-            getattr(Player, f"{rules}_rank") != None).order_by(
-            getattr(Player, f"{rules}_rank").desc())
-
-        all_700plus = all_players.filter(
-            getattr(Player, f"{rules}_rank") > 700)
-
-        self.player_count = len(all_players.all())
-        # save this value in the db
-        key = f"player_count_{rules}"
-        setting = self.db.query(Settings).filter_by(key=key).first()
-        new = setting is None
-        if new:
-            setting = Settings()
-            setting.key = key
-        setting.value = self.player_count
-        if new:
-            self.db.add(setting)
-        self.db.commit()
-
-        self.players700plus = len(all_700plus.all())
-        for c in self.db.query(Country).filter(Country.id != "??").filter(
-                Country.ema_since is not None):
-            c.ema_since = None if c.id in ("ru", "by") else datetime.now()
-            c_all = all_players.filter(Player.country_id == c.id)
-            player_count = len(c_all.all())
-            c_700plus = len(
-                all_700plus.filter(Player.country_id == c.id).all()
-                )
-            setattr(c, f"player_count_{rules}", player_count)
-            setattr(c, f"over700_{rules}", c_700plus)
-            setattr(c, f"country_ranking_{rules}", None)
-            if player_count > 0:
-                top3 = c_all.limit(3)
-                top3ranks = [getattr(p, f"{rules}_rank") for p in top3]
-                average_rank_of_top3_players = round(sum(top3ranks)/3, 2)
-            else:
-                average_rank_of_top3_players = None
-
-            setattr(c, f"average_rank_of_top3_players_{rules}",
-                    average_rank_of_top3_players)
-
-            if average_rank_of_top3_players is not None:
-                ema.append([c.id, average_rank_of_top3_players, player_count])
-
-        ema.sort(key=lambda x: x[1], reverse=True)
+        stats = self.stats(ranking_numpy.live_snapshot(self.db))
+
+        if write_to_db:
+            now = datetime.now()
+            rows = {c: {
+                "id": c,
+                "ema_since": None if c in ("ru", "by") else now,
+                } for c in self.country_ids}
+            for ruleset in rulesets:
+                rules = ruleset.value
+                for c, pos, player_count, over700, average in stats[ruleset]:
+                    rows[c].update({
+                        f"country_ranking_{rules}": pos,
+                        f"player_count_{rules}": player_count,
+                        f"over700_{rules}": over700,
+                        f"average_rank_of_top3_players_{rules}": average,
+                        })
+            self.db.execute(update(Country), list(rows.values()))
+            self.db.commit()
 
         if assess:
-            total = 0
-            bad = 0
-            suffix = "MCR" if is_mcr else "RCR"
-            url = f"https://silk.mahjong.ie/ranking/BestNation_{suffix}.html"
-            official = Country_Scraper.scrape_country_rankings(url)
+            for ruleset in rulesets:
+                self.assess_country_ranking(ruleset, stats[ruleset])
+        return stats
 
+    def rank_countries_for_one_ruleset(
+            self,
+            ruleset: Ruleset,
+            write_to_db: bool = True,
+            reckoning_day: datetime = None,
+            assess: bool = False,
+            ):
+        return self.rank_countries(write_to_db, reckoning_day, assess,
+                                   (ruleset,))
+
+    def rank_countries_on(self, reckoning_days, save=True,
+                          processes: int = None) -> dict:
+        """ the country ranking on each of the given days, e.g. the cutoff
+        dates for a quota tournament, in one sweep of the player ranking.
+        Neither the live player ranking nor the Country rows are touched.
+        Returns {reckoning_day: {ruleset: [(country_id, position,
+        player_count, over700, top3_average), ...]}}, and if save is set,
+        also stores it in country_rank_history """
+        snapshots = PlayerRankingEngine(self.db).sweep(
+            reckoning_days, processes=processes)
+        history = {day: self.stats(snapshot)
+                   for day, snapshot in snapshots.items()}
+        if save:
+            self.save_history(history)
+        return history
+
+    def save_history(self, history: dict):
+        """ store the output of rank_countries_on, replacing whatever was
+        stored for those days """
+        rows = []
+        for day, stats in history.items():
+            self.db.execute(delete(CountryRankHistory).where(
+                CountryRankHistory.reckoning_day == day))
+            for ruleset, countries in stats.items():
+                for c, pos, player_count, over700, average in countries:
+                    rows.append({
+                        "reckoning_day": day,
+                        "ruleset": ruleset,
+                        "country_id": c,
+                        "position": pos,
+                        "player_count": player_count,
+                        "over700": over700,
+                        "average_rank_of_top3_players": average,
+                        })
+        if rows:
+            self.db.execute(insert(CountryRankHistory.__table__), rows)
+        self.db.commit()
 
-        pos = 1
-        logging.info(f"Country rankings for {ruleset}")
-        for q in ema:
-            c = self.db.query(Country).filter_by(id=q[0]).first()
-            setattr(c, f"country_ranking_{rules}", pos)
-
-            if assess:
-                test = official[pos-1]
-                total += 1
-                if q[0] != test['country']:
-                    bad += 1
-                    logging.warning(f"#{pos} Country mismatch- official "
-                                    f"{test['country']}, we think {q[0]}")
-                if q[2] != test['player_count']:
-                    bad += 1
-                    logging.warning(f"#{pos} player count mismatch- official "
-                                    f"{test['player_count']}, "
-                                    f"we think {q[2]}")
-                if abs(q[1] - test['top3_average']) > 0.02:
-                    bad += 1
-                    logging.warning(f"#{pos} top3 average mismatch- official "
-                                    f"{test['top3_average']}, we think "
-                                    f"{q[1]}")
-
-            pos += 1
-
-        if assess:
-            logging.info(f"{total} rows tested, {bad} rows bad")
+    def trajectory(self, country_id: str, ruleset: Ruleset,
+                   start: datetime = None, end: datetime = None):
+        """ (reckoning_day, position, player_count, over700, top3_average)
+        for every stored ranking of the country, oldest first """
+        query = select(
+            CountryRankHistory.reckoning_day,
+            CountryRankHistory.position,
+            CountryRankHistory.player_count,
+            CountryRankHistory.over700,
+            CountryRankHistory.average_rank_of_top3_players,
+            ).where(CountryRankHistory.country_id == country_id).where(
+            CountryRankHistory.ruleset == ruleset).order_by(
+            CountryRankHistory.reckoning_day)
+        if start is not None:
+            query = query.where(CountryRankHistory.reckoning_day >= start)
+        if end is not None:
+            query = query.where(CountryRankHistory.reckoning_day <= end)
+        return [tuple(row) for row in self.db.execute(query)]
+
+    def assess_country_ranking(self, ruleset: Ruleset, stats):
+        """ compare our country ranking with the official one """
+        total = 0
+        bad = 0
+        suffix = "MCR" if ruleset == Ruleset.mcr else "RCR"
+        url = f"https://silk.mahjong.ie/ranking/BestNation_{suffix}.html"
+        official = Country_Scraper.scrape_country_rankings(url)
 
-        self.db.commit()
+        logging.info(f"Country rankings for {ruleset}")
+        ema = sorted((s for s in stats if s[1] is not None),
+                     key=lambda s: s[1])
+        for c, pos, player_count, over700, average in ema:
+            test = official[pos-1]
+            total += 1
+            if c != test['country']:
+                bad += 1
+                logging.warning(f"#{pos} Country mismatch- official "
+                                f"{test['country']}, we think {c}")
+            if player_count != test['player_count']:
+                bad += 1
+                logging.warning(f"#{pos} player count mismatch- official "
+                                f"{test['player_count']}, "
+                                f"we think {player_count}")
+            if abs(average - test['top3_average']) > 0.02:
+                bad += 1
+                logging.warning(f"#{pos} top3 average mismatch- official "
+                                f"{test['top3_average']}, we think "
+                                f"{average}")
+
+        logging.info(f"{total} rows tested, {bad} rows bad")
@@ -11,7 +11,7 @@ from models import Player, Tournament, PlayerTournament, Ruleset, Country
 from utils.scrapers import Tournament_Scraper
 from calculators.ranking import PlayerRankingEngine
 
-def results_to_db(db, file: str, sheet: str) -> Tournament:
+def results_to_db(db, file: str, sheet: str, rerank=False) -> Tournament:
     book = xlrd.open_workbook(file)
     sh = book.sheet_by_name(sheet)
 
@@ -89,4 +89,7 @@ def results_to_db(db, file: str, sheet: str) -> Tournament:
 
     db.commit()
 
+    if rerank:
+        PlayerRankingEngine(db).rank_tournament_players(t)
+
     return t
@@ -57,18 +57,93 @@
 #
 # ================================================
 
+import csv
+from datetime import datetime
+import json
 import logging
 
-from models import Player, Country, Ruleset
+import numpy as np
+from sqlalchemy import select
+
+from models import Country, QuotaAllocation, QuotaRun, Ruleset
+from calculators import ranking_numpy
+from calculators.country_ranking import CountryRankingEngine
+from calculators.ranking import PlayerRankingEngine
+
+
+def part_b_seats(weights: list[int], denominator: int):
+    """ the order in which Part B seats are handed out, one seat at a time.
+
+    Country i's share of Part B is weights[i] / denominator, in exact
+    integers, so that ties are real ties rather than float noise. With
+    `scalar` seats notionally available, each country's deficit is
+    scalar * share - seats so far, and the seat goes to the biggest
+    deficit. Deficits grow at different rates as scalar goes up, so their
+    order changes from seat to seat, and each seat is a scan of every
+    country. Ties go to the country listed first, i.e. the best in the
+    country ranking.
+
+    Yields (scalar, idx, tied) for every seat, where tied lists any other
+    countries with the same deficit, for as long as seats are wanted """
+    if not any(w > 0 for w in weights):
+        return
+    seats = [0] * len(weights)
+    scalar = 0
+    while True:
+        scalar += 1
+        deficits = [scalar * w - denominator * seats[i]
+                    for i, w in enumerate(weights)]
+        deficit = max(deficits)
+        if deficit <= 0:
+            continue
+        idx = deficits.index(deficit)
+        tied = [i for i in range(idx + 1, len(deficits))
+                if deficits[i] == deficit]
+        seats[idx] += 1
+        yield scalar, idx, tied
+
+
+def ranked_countries(stats, ruleset: Ruleset, names: dict) -> list[Country]:
+    """ the countries as rank_countries would leave them in the database,
+    best first, from one ruleset of CountryRankingEngine.stats. They are
+    new Country objects, not added to the session, so the Country rows are
+    never touched. Russia and Belarus are suspended, so are left out """
+    rules = ruleset.value
+    countries = [Country(
+        id=c,
+        name_english=names[c],
+        **{f"player_count_{rules}": player_count,
+           f"over700_{rules}": over700,
+           f"average_rank_of_top3_players_{rules}": average},
+        ) for c, pos, player_count, over700, average in stats
+        if c not in ("ru", "by")]
+    countries.sort(key=lambda c: getattr(
+        c, f"average_rank_of_top3_players_{rules}") or -1, reverse=True)
+    return countries
+
 
 class QuotaMaker():
-    def __init__(self, db, quota: int, ruleset: Ruleset):
+    def __init__(self, db, quota: int, ruleset: Ruleset, event: str = None,
+                 cutoff_date: datetime = None):
         self.db = db
         self.total = quota
         self.remaining = quota
+        self.ruleset = ruleset
         self.rules = "mcr" if ruleset == Ruleset.mcr else "riichi"
+        # what the quotas are for, when they're saved
+        self.event = event
+        self.cutoff_date = cutoff_date
+        # the day of the player ranking used, if it isn't the live one
+        self.reckoning_day = None
+        self.run = None
         self.quotas = []
         self.partB = []
+        # (scalar, country, [countries tied with it]) for Part B seats that
+        # were decided by the country ranking
+        self.collisions = []
+        # the Part B seats handed out so far, shared by every total
+        self.part_b_sequence = []
+        self.part_b_seats = None
 
     def seat(self, idx: int, seats: int = 1):
         if seats < 0:
@@ -77,31 +152,54 @@ class QuotaMaker():
         self.remaining -= seats
         self.quotas[idx]["quota"] += seats
 
-    def calc_caps(self):
+    def calc_caps(self, snapshot: ranking_numpy.Snapshot = None,
+                  countries: CountryRankingEngine = None):
+        """ the caps and Part B shares, from one array of every player's
+        rank (the live ranking, unless a Snapshot is given) rather than a
+        query per country. countries can give a CountryRankingEngine that
+        already knows each player's country """
         self.quotas = []
         self.remaining = self.total
 
-        players = self.db.query(Player).filter(
-            Player.ema_id != -1).filter(
-            Player.country_id != "??")
-        players = players.filter(getattr(Player, f"{self.rules}_rank") != None)
-        rank_column = f"{self.rules}_rank"
-        player_count = len(players.all())
-        self.average = sum(getattr(p, rank_column) for p in players) \
-            / player_count
+        if snapshot is None:
+            snapshot = ranking_numpy.live_snapshot(self.db)
+        if countries is None:
+            countries = CountryRankingEngine(self.db)
+            countries.load_countries(snapshot.player_ids)
+        # EMA players with a rank and a country
+        ranked = (snapshot.positions[self.ruleset] > 0) & \
+            (countries.player_countries >= 0)
+        ranks = snapshot.ranks[self.ruleset][ranked]
+        player_count = len(ranks)
+        # added up one at a time, in player order, like sum() always has
+        self.average = sum(ranks.tolist()) / player_count
+        above_average = np.bincount(
+            countries.player_countries[ranked][ranks > self.average],
+            minlength=len(countries.country_ids))
+        index = {c: i for i, c in enumerate(countries.country_ids)}
 
         player700_count = 0
         for c in self.countries:
             player700_count += getattr(c, f"over700_{self.rules}")
+        self.player_count = player_count
+        self.player700_count = player700_count
+
+        # if nobody is over 700, every country's partB2 is 0
+        over700_total = player700_count or 1
+
+        # partB3 = weight / denominator, in integers
+        self.denominator = 2 * player_count * over700_total
+        self.weights = []
 
         for pos, c in enumerate(self.countries):
-            local_players = players.filter(Player.country_id==c.id)
             partB1 = getattr(c, f"player_count_{self.rules}") / player_count
-            partB2 = getattr(c, f"over700_{self.rules}") / player700_count
+            partB2 = getattr(c, f"over700_{self.rules}") / over700_total
             partB3 = (partB1 + partB2) / 2
+            self.weights.append(
+                getattr(c, f"player_count_{self.rules}") * over700_total +
+                getattr(c, f"over700_{self.rules}") * player_count)
 
-            cap = len(local_players.filter(
-                getattr(Player, rank_column) > self.average).all())
+            cap = int(above_average[index[c.id]])
             self.quotas.append({
                 "cap": max(1, cap),
                 "quota": 0,
@@ -111,12 +209,64 @@ class QuotaMaker():
                 })
 
 
-    def make(self):
-        self.countries = self.db.query(Country).filter(
-            Country.id != "??").filter(
-            Country.ema_since != None).order_by(getattr(
-            Country, f"average_rank_of_top3_players_{self.rules}").desc())
-        self.calc_caps()
+    def load(self, countries: list[Country] = None,
+             snapshot: ranking_numpy.Snapshot = None,
+             country_ranking: CountryRankingEngine = None):
+        """ the countries, their caps and their Part B shares. These don't
+        depend on the total, so they're only worked out once.
+        By default everything comes from the database. For a ranking made
+        in memory, give the countries (best first, with their counts filled
+        in), the Snapshot, and a CountryRankingEngine with its countries
+        loaded; then the database isn't used at all """
+        if countries is None:
+            countries = self.db.query(Country).filter(
+                Country.id != "??").filter(
+                Country.ema_since != None).order_by(getattr(
+                Country, f"average_rank_of_top3_players_{self.rules}").desc(
+                )).all()
+        self.countries = countries
+        self.calc_caps(snapshot, country_ranking)
+        self.part_b_sequence = []
+        self.part_b_seats = part_b_seats(self.weights, self.denominator)
+
+    def load_at(self, snapshot: ranking_numpy.Snapshot):
+        """ load() from a Snapshot of the player ranking, e.g. from
+        PlayerRankingEngine.rank_at on a cutoff date, with the countries
+        ranked in memory. Neither the live ranking nor the Country rows are
+        touched """
+        country_ranking = CountryRankingEngine(self.db)
+        stats = country_ranking.stats(snapshot)[self.ruleset]
+        names = dict(self.db.execute(select(
+            Country.id, Country.name_english)).all())
+        self.load(ranked_countries(stats, self.ruleset, names), snapshot,
+                  country_ranking)
+        self.reckoning_day = snapshot.reckoning_day
+
+    def next_part_b_seat(self, n: int):
+        """ the nth Part B seat, extending the sequence if need be """
+        while len(self.part_b_sequence) <= n:
+            seat = next(self.part_b_seats, None)
+            if seat is None:
+                return None
+            self.part_b_sequence.append(seat)
+        return self.part_b_sequence[n]
+
+    def make(self, snapshot: ranking_numpy.Snapshot = None):
+        """ make and save the quotas, from the live ranking, or from the
+        given Snapshot of the player ranking """
+        if snapshot is None:
+            self.load()
+        else:
+            self.load_at(snapshot)
+        self.allocate(self.total)
+        self.wrap_up()
+
+    def allocate(self, total: int):
+        """ share out total seats, after load() """
+        self.total = total
+        self.remaining = total
+        for c in self.quotas:
+            c["quota"] = 0
 
 
         # one seat per country
@@ -141,31 +291,19 @@ class QuotaMaker():
 
         # redistribution proportional to PART B3
 
-        for pos, c in enumerate(self.countries):
-            self.partB.append(0)
-
-        scalar = 0
+        self.partB = [0] * len(self.quotas)
+        self.collisions = []
+        n = 0
         while self.remaining > 0:
-            scalar += 1
-
-            scores = []
-            for pos, c in enumerate(self.quotas):
-                # find which country has the biggest discrepancy between
-                # its partB3*N and its current quota,
-                # and increase the quota for that country
-                b3 = scalar * c["partB3"] - self.partB[pos]
-                scores.append(b3)
-
-            m = max(scores)
-            if m > 0:
-                incr = scores.index(m)
-                if m in scores[incr+1:]:
-                    logging.warning(f"partb3 collision with scalar={scalar},"
-                        f"{self.countries[incr].name_english} and "
-                        f"{self.countries[scores[incr+1:].index(m)].name_english}")
-                    logging.warning(scores)
-                self.seat(incr)
-                self.partB[incr] += 1
+            seat = self.next_part_b_seat(n)
+            if seat is None:
+                break
+            n += 1
+            scalar, incr, tied = seat
+            if tied:
+                self.collisions.append((scalar, incr, tied))
+            self.seat(incr)
+            self.partB[incr] += 1
 
 
         # apply cap
@@ -187,18 +325,123 @@ class QuotaMaker():
                 logging.error("unable to allocate remaining {remaining} seats")
                 break
 
-
-        self.wrap_up()
+    def curves(self, totals) -> dict:
+        """ the quotas for each of several totals, e.g. range(120, 149), in
+        one run. The caps and Part B shares are worked out once, and the
+        Part B seats are extended one at a time as the total grows.
+        Returns {total: [quota for each country, in country ranking order]} """
+        self.load()
+        curves = {}
+        for total in sorted(totals):
+            self.allocate(total)
+            curves[total] = [c["quota"] for c in self.quotas]
+        return curves
+
+    def write_curves_csv(self, file, curves: dict):
+        """ write curves() to an open text file, as a matrix of one row per
+        country and one column per total """
+        totals = list(curves)
+        writer = csv.writer(file)
+        writer.writerow(["country", "name"] + totals)
+        for pos, c in enumerate(self.countries):
+            writer.writerow([c.id, c.name_english] +
+                            [curves[total][pos] for total in totals])
+
+    def write_curves_json(self, file, curves: dict):
+        """ write curves() to an open text file, as JSON """
+        json.dump({
+            "ruleset": self.rules,
+            "totals": list(curves),
+            "countries": {c.id: [curves[total][pos] for total in curves]
+                          for pos, c in enumerate(self.countries)},
+            }, file, indent=1)
 
     def wrap_up(self):
-        """ save our quotas somewhere """ # TODO
+        """ save our quotas, and log them """
+        self.save()
         logging.info(f"\n QUOTAS for {self.rules}, total {self.total}\n")
         for pos, c in enumerate(self.quotas):
             d = {k: round(v, 5) if isinstance(v, float) else v
                  for k, v in c.items()}
             logging.info(f"#{pos+1} {self.countries[pos].name_english} {d}")
 
+        for scalar, idx, tied in self.collisions:
+            names = ", ".join(self.countries[i].name_english for i in tied)
+            logging.info(f"Part B collision with scalar={scalar}: "
+                         f"{self.countries[idx].name_english} got the seat "
+                         f"by country ranking, tied with {names}")
+
         if self.remaining:
             logging.info(f"{self.remaining} unable to be allocated")
         else:
             logging.info("full quota allocated")
+
+    def save(self) -> QuotaRun:
+        """ store this run, and each country's allocation, in quota_run and
+        quota_allocation """
+        self.run = QuotaRun(
+            event=self.event,
+            ruleset=self.ruleset,
+            total=self.total,
+            cutoff_date=self.cutoff_date,
+            reckoning_day=self.reckoning_day or
+                PlayerRankingEngine(self.db).live_reckoning_day(),
+            calculated=datetime.now(),
+            player_count=self.player_count,
+            over700_count=self.player700_count,
+            average=self.average,
+            unallocated=self.remaining,
+            collisions=[
+                [scalar, self.countries[idx].id,
+                 [self.countries[i].id for i in tied]]
+                for scalar, idx, tied in self.collisions],
+            )
+        for pos, c in enumerate(self.quotas):
+            self.run.allocations.append(QuotaAllocation(
+                country_id=self.countries[pos].id,
+                position=pos + 1,
+                cap=c["cap"],
+                quota=c["quota"],
+                part_b=self.partB[pos],
+                part_b1=c["partB1"],
+                part_b2=c["partB2"],
+                part_b3=c["partB3"],
+                ))
+        self.db.add(self.run)
+        self.db.commit()
+        return self.run
+
+    @staticmethod
+    def stored(db, event: str, ruleset: Ruleset, total: int,
+               cutoff_date: datetime = None):
+        """ the latest saved run for this event, ruleset, total and cutoff
+        date, or None. Runs made from the live ranking (no cutoff date) only
+        count if the live ranking hasn't been re-ranked to another day since
+        """
+        query = select(QuotaRun).where(QuotaRun.event == event).where(
+            QuotaRun.ruleset == ruleset).where(
+            QuotaRun.total == total).where(
+            QuotaRun.cutoff_date == cutoff_date).order_by(
+            QuotaRun.calculated.desc()).limit(1)
+        if cutoff_date is None:
+            query = query.where(QuotaRun.reckoning_day ==
+                                PlayerRankingEngine(db).live_reckoning_day())
+        return db.scalars(query).first()
+
+    @classmethod
+    def quota_for(cls, db, event: str, ruleset: Ruleset, total: int,
+                  cutoff_date: datetime = None, refresh=False) -> QuotaRun:
+        """ the quotas for an event, from a stored run if we have one. If
+        not, or if refresh is set, the quotas are made and saved: from the
+        live ranking, or if there's a cutoff date, from the players and
+        countries ranked in memory on that day, leaving the live ranking as
+        it is """
+        run = None if refresh else cls.stored(
+            db, event, ruleset, total, cutoff_date)
+        if run is None:
+            snapshot = None if cutoff_date is None else \
+                PlayerRankingEngine(db).rank_at(cutoff_date)
+            maker = cls(db, total, ruleset, event, cutoff_date)
+            maker.make(snapshot)
+            run = maker.run
+        return run
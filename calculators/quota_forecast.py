@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+'''
+Monte Carlo forecast of the quotas for a tournament with a future cutoff.
+
+Each sample plays out the time between now and the cutoff date: every
+player who has been active recently plays a Poisson-distributed number of
+further tournaments at their current rate, and gets a base rank and MERS
+drawn from their own recent results. The players are then ranked on the
+cutoff date with the vectorised engine, the countries are ranked from that,
+and the quotas are made, all in memory. Repeating this many times, across a
+pool of processes, gives a probability distribution of seats per country.
+'''
+import csv
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import os
+
+import numpy as np
+from sqlalchemy import select
+
+from models import Country, Ruleset
+from calculators import ranking_numpy
+from calculators.country_ranking import CountryRankingEngine
+from calculators.quota import QuotaMaker, ranked_countries
+
+# samples are run in chunks of this size, each with its own seed, so the
+# same seed gives the same samples however many processes there are
+CHUNK = 50
+
+# set in each worker process by _start_worker, so the model is only sent
+# to each worker once
+_forecast = None
+
+
+def _start_worker(forecast):
+    global _forecast
+    _forecast = forecast
+
+
+def _simulate(seed, samples: int):
+    return _forecast.simulate_chunk(seed, samples)
+
+
+class QuotaForecast:
+    """ the model that each sample is drawn from. Everything needed is read
+    from the database up front, so that samples can run in other processes
+    """
+    def __init__(self, db, ruleset: Ruleset, total: int,
+                 cutoff_date: datetime, start: datetime = None,
+                 years: int = 2):
+        self.ruleset = ruleset
+        self.rules = ruleset.value
+        self.total = total
+        self.cutoff_date = cutoff_date
+        self.start = start or datetime.now()
+        if self.cutoff_date <= self.start:
+            raise ValueError(f"cutoff date {cutoff_date} is not after "
+                             f"{self.start}")
+
+        history = ranking_numpy.load_history(db)
+        in_ruleset = history["ruleset"] == ranking_numpy.RULESETS.index(
+            ruleset)
+        # results on or after the start aren't known yet
+        known = history["end_date"] <= np.datetime64(self.start, "us")
+        self.history = {k: v[in_ruleset & known] for k, v in history.items()}
+        self.player_ids, self.ema_players = ranking_numpy.load_players(db)
+
+        self.country_ranking = CountryRankingEngine(db)
+        self.country_ranking.load_countries(self.player_ids)
+        # the session can't go to the worker processes, and isn't needed
+        self.country_ranking.db = None
+        self.names = dict(db.execute(select(
+            Country.id, Country.name_english)).all())
+
+        self.fit(years)
+
+    def fit(self, years: int):
+        """ each player's rate of play, per year, and the pool of recent
+        results that their future results are drawn from """
+        recent = self.history["effective_end_date"] >= np.datetime64(
+            self.start, "us") - np.timedelta64(round(365.25 * years), "D")
+        recent &= self.history["mers"] > 0
+        pool_player = self.history["player_id"][recent]
+        self.pool_base_rank = self.history["base_rank"][recent]
+        self.pool_mers = self.history["mers"][recent]
+        # history is ordered by player, so each pool is a contiguous slice
+        self.active, self.pool_start, self.pool_size = np.unique(
+            pool_player, return_index=True, return_counts=True)
+        horizon = (self.cutoff_date - self.start).days / 365.25
+        self.expected = self.pool_size / years * horizon
+
+    def sample_history(self, rng):
+        """ the known history, plus one random future up to the cutoff """
+        played = rng.poisson(self.expected)
+        player = np.repeat(np.arange(len(self.active)), played)
+        pick = self.pool_start[player] + (
+            rng.random(len(player)) * self.pool_size[player]).astype(np.int64)
+        span = np.datetime64(self.cutoff_date, "us") - \
+            np.datetime64(self.start, "us")
+        dates = np.datetime64(self.start, "us") + (
+            rng.random(len(player)) * span).astype("timedelta64[us]")
+        future = {
+            "player_id": self.active[player],
+            "ruleset": np.full(len(player), ranking_numpy.RULESETS.index(
+                self.ruleset), dtype=np.int8),
+            "base_rank": self.pool_base_rank[pick],
+            "mers": self.pool_mers[pick],
+            "effective_end_date": dates,
+            "end_date": dates,
+            }
+        return {k: np.concatenate((self.history[k], future[k]))
+                for k in self.history}
+
+    def quotas(self, history) -> list[int]:
+        """ rank the players and the countries on the cutoff date from the
+        given history, and return the quota for each country, in
+        country_ids order """
+        weights = ranking_numpy.aged_mers(history, self.cutoff_date)
+        counted = weights > 0
+        players, ranks = ranking_numpy.rank_one_ruleset(
+            history["player_id"][counted],
+            history["base_rank"][counted],
+            weights[counted],
+            )
+        ranked = {r: (np.zeros(0, dtype=np.int64), np.zeros(0))
+                  for r in ranking_numpy.RULESETS}
+        ranked[self.ruleset] = (players, np.rint(ranks * 100) / 100)
+        snapshot = ranking_numpy.snapshot(
+            self.cutoff_date, self.player_ids, self.ema_players, ranked)
+
+        countries = ranked_countries(
+            self.country_ranking.stats(snapshot)[self.ruleset], self.ruleset,
+            self.names)
+
+        maker = QuotaMaker(None, self.total, self.ruleset)
+        maker.load(countries, snapshot, self.country_ranking)
+        maker.allocate(self.total)
+        seats = dict.fromkeys(self.country_ranking.country_ids, 0)
+        for c, quota in zip(maker.countries, maker.quotas):
+            seats[c.id] = quota["quota"]
+        return list(seats.values())
+
+    def simulate_chunk(self, seed, samples: int):
+        rng = np.random.default_rng(seed)
+        return np.array([self.quotas(self.sample_history(rng))
+                         for _ in range(samples)], dtype=np.int64)
+
+    def simulate(self, samples: int, processes: int = None,
+                 seed: int = None) -> np.ndarray:
+        """ run the samples, split between a pool of processes, and return
+        an array of samples x countries, in country_ids order """
+        if samples < 1:
+            raise ValueError(f"can't run {samples} samples")
+        processes = processes or os.cpu_count() or 1
+        sizes = [min(CHUNK, samples - i) for i in range(0, samples, CHUNK)]
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+        with ProcessPoolExecutor(processes, initializer=_start_worker,
+                                 initargs=(self,)) as pool:
+            results = list(pool.map(_simulate, seeds, sizes))
+        self.samples = np.concatenate(results)
+        return self.samples
+
+    def summary(self):
+        """ (country_id, name, quota with no new results, mean quota,
+        probability of gaining a seat or more, probability of losing one or
+        more, {seats: probability}) for every country, from the last
+        simulate(). The quota with no new results is the one on the cutoff
+        date if nobody plays again, with the known results aged to that
+        date, and gaining or losing seats is measured against it """
+        baseline = self.quotas(self.history)
+        rows = []
+        for i, c in enumerate(self.country_ranking.country_ids):
+            seats = self.samples[:, i]
+            values, counts = np.unique(seats, return_counts=True)
+            rows.append((
+                c,
+                self.names[c],
+                baseline[i],
+                float(seats.mean()),
+                float(np.mean(seats > baseline[i])),
+                float(np.mean(seats < baseline[i])),
+                {int(v): n / len(seats) for v, n in zip(values, counts)},
+                ))
+        return rows
+
+    def write_csv(self, file):
+        """ write summary() to an open text file, with a column for the
+        probability of each number of seats. gain and lose are measured
+        against no_new_results """
+        rows = self.summary()
+        seat_counts = sorted({s for row in rows for s in row[6]})
+        writer = csv.writer(file)
+        writer.writerow(["country", "name", "no_new_results", "mean", "gain", "lose"] +
+                        [f"{s} seats" for s in seat_counts])
+        for row in rows:
+            writer.writerow(
+                [row[0], row[1], row[2], round(row[3], 3), round(row[4], 4),
+                 round(row[5], 4)] +
+                [round(row[6].get(s, 0), 4) for s in seat_counts])
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+'''
+Store and look up historic player rankings, in the rank_history table.
+
+Rankings are saved per reckoning day, either from the live ranking in the
+player table, or from Snapshots made by PlayerRankingEngine.sweep/rank_at.
+Lookups on a date use the most recent saved ranking on or before that date.
+'''
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import delete, insert, literal, select
+
+from models import Player, RankHistory, Ruleset
+
+
+class RankHistoryStore:
+    def __init__(self, db):
+        self.db = db
+
+    def clear(self, reckoning_day: datetime):
+        self.db.execute(delete(RankHistory).where(
+            RankHistory.reckoning_day == reckoning_day))
+
+    def save_live(self, reckoning_day: datetime):
+        """ copy the live ranks and positions from the player table, in one
+        INSERT ... SELECT per ruleset """
+        self.clear(reckoning_day)
+        for ruleset in Ruleset:
+            rank_column = getattr(Player, f"{ruleset.value}_rank")
+            self.db.execute(insert(RankHistory).from_select(
+                ["reckoning_day", "ruleset", "player_id", "rank", "position"],
+                select(
+                    literal(reckoning_day, RankHistory.reckoning_day.type),
+                    literal(ruleset, RankHistory.ruleset.type),
+                    Player.id,
+                    rank_column,
+                    getattr(Player, f"{ruleset.value}_position"),
+                    ).where(rank_column != None)))
+        self.db.commit()
+
+    def save(self, snapshots):
+        """ save one or more Snapshots, with a bulk insert per snapshot """
+        if not isinstance(snapshots, (list, tuple)):
+            snapshots = [snapshots]
+        for snapshot in snapshots:
+            self.clear(snapshot.reckoning_day)
+            rows = []
+            for ruleset in Ruleset:
+                ranks = snapshot.ranks[ruleset]
+                positions = snapshot.positions[ruleset]
+                for i in np.flatnonzero(~np.isnan(ranks)):
+                    rows.append({
+                        "reckoning_day": snapshot.reckoning_day,
+                        "ruleset": ruleset,
+                        "player_id": int(snapshot.player_ids[i]),
+                        "rank": float(ranks[i]),
+                        "position": int(positions[i]) or None,
+                        })
+            if rows:
+                self.db.execute(insert(RankHistory.__table__), rows)
+        self.db.commit()
+
+    def reckoning_days(self, ruleset: Ruleset = None) -> list[datetime]:
+        query = select(RankHistory.reckoning_day).distinct().order_by(
+            RankHistory.reckoning_day)
+        if ruleset is not None:
+            query = query.where(RankHistory.ruleset == ruleset)
+        return list(self.db.scalars(query))
+
+    def _day_on_or_before(self, day: datetime, ruleset: Ruleset):
+        return select(RankHistory.reckoning_day).where(
+            RankHistory.ruleset == ruleset).where(
+            RankHistory.reckoning_day <= day).order_by(
+            RankHistory.reckoning_day.desc()).limit(1).scalar_subquery()
+
+    def rank_on(self, player_id: int, day: datetime, ruleset: Ruleset):
+        """ the player's (rank, position) on the given date, or None if they
+        weren't ranked """
+        row = self.db.execute(select(
+            RankHistory.rank, RankHistory.position).where(
+            RankHistory.player_id == player_id).where(
+            RankHistory.ruleset == ruleset).where(
+            RankHistory.reckoning_day == self._day_on_or_before(
+                day, ruleset))).first()
+        return None if row is None else tuple(row)
+
+    def top(self, day: datetime, ruleset: Ruleset, n: int = 10):
+        """ the top n (player_id, rank, position) on the given date """
+        return [tuple(row) for row in self.db.execute(select(
+            RankHistory.player_id, RankHistory.rank, RankHistory.position).where(
+            RankHistory.ruleset == ruleset).where(
+            RankHistory.reckoning_day == self._day_on_or_before(
+                day, ruleset)).where(
+            RankHistory.position != None).order_by(
+            RankHistory.position, RankHistory.player_id).limit(n))]
+
+    def trajectory(self, player_id: int, ruleset: Ruleset,
+                   start: datetime = None, end: datetime = None):
+        """ (reckoning_day, rank, position) for every saved ranking of the
+        player, oldest first, e.g. for a sparkline on their profile page """
+        query = select(
+            RankHistory.reckoning_day, RankHistory.rank,
+            RankHistory.position).where(
+            RankHistory.player_id == player_id).where(
+            RankHistory.ruleset == ruleset).order_by(
+            RankHistory.reckoning_day)
+        if start is not None:
+            query = query.where(RankHistory.reckoning_day >= start)
+        if end is not None:
+            query = query.where(RankHistory.reckoning_day <= end)
+        return [tuple(row) for row in self.db.execute(query)]
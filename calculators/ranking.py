@@ -45,6 +45,11 @@
 
 # Final ranking = 0.5 * Part A + 0.5 * Part B
 
+# Position = 1 + the number of EMA players with a strictly higher ranking.
+# So players with equal rankings share a position, and the next position is
+# skipped ("1224" ranking). e.g. if two players are tied in 2nd place,
+# the next player is 4th. Players without an EMA id don't get a position.
+
 # ================================================
 #
 #          Code starts here
@@ -52,12 +57,76 @@
 # ================================================
 
 import logging
+import os
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
 from datetime import date, datetime
+from itertools import groupby, repeat
 from math import ceil
+from operator import itemgetter
+
+from sqlalchemy import Integer, case, cast, delete, func, insert, select, update
+
+from models import Player, Tournament, PlayerTournament, Ruleset, Settings, \
+                   RankExplanation
+from calculators import ranking_numpy
+from calculators.rank_history import RankHistoryStore
+from calculators.ranking_diff import RankingDiff
+from utils.loaders import load_players, QueryCounter
+
+ENGINES = ("python", "numpy", "parallel", "sql")
+
+
+class Result:
+    """ just the parts of a PlayerTournament that the ranking needs. These
+    are much smaller and quicker to make than ORM objects """
+    __slots__ = ("base_rank", "aged_mers", "ruleset", "tournament_id")
 
-from sqlalchemy import update
+    def __init__(self, base_rank, aged_mers, ruleset=None, tournament_id=0):
+        self.base_rank = base_rank
+        self.aged_mers = aged_mers
+        self.ruleset = ruleset
+        self.tournament_id = tournament_id
 
-from models import Player, Tournament, PlayerTournament, Ruleset, Settings
+    @classmethod
+    def from_row(cls, pt: PlayerTournament):
+        return cls(pt.base_rank, pt.aged_mers, pt.ruleset, pt.tournament_id)
+
+    def __repr__(self):
+        return (f"Result({self.base_rank}, {self.aged_mers}, "
+                f"{self.ruleset}, {self.tournament_id})")
+
+
+# dummy result used to pad out players with fewer than 5 results
+PADDING = Result(base_rank=0, aged_mers=1.0)
+
+
+def rank_chunk(chunk):
+    """ rank a chunk of players, in a worker process for rank_in_parallel.
+    chunk is a list of (player_id, results) where each result is a
+    (base_rank, aged_mers, ruleset, tournament_id) tuple. Returns a list of
+    (player_id, ruleset, rank) for the players who have a rank """
+    ranked = []
+    for player_id, results in chunk:
+        results = [Result(*r) for r in results]
+        for ruleset in Ruleset:
+            rank = PlayerRankingEngine.calculate_rank(
+                [r for r in results if r.ruleset == ruleset])
+            if rank is not None:
+                # rounded the same way as Player.rank
+                ranked.append((player_id, ruleset, round(rank * 100) / 100))
+    return ranked
+
+
+def merge_chunks(chunks):
+    """ merge the outputs of rank_chunk into a dict of
+    ruleset: (player ids, ranks), for ranking_numpy.write_ranks """
+    ranked = {ruleset: ([], []) for ruleset in Ruleset}
+    for chunk in chunks:
+        for player_id, ruleset, rank in chunk:
+            ranked[ruleset][0].append(player_id)
+            ranked[ruleset][1].append(rank)
+    return ranked
 
 class PlayerRankingEngine:
     def __init__(self, db):
@@ -76,74 +145,208 @@ class PlayerRankingEngine:
     def weighted_average(ranks, weights):
         return sum([a * b for a, b in zip(ranks, weights)])/ sum(weights)
 
+    @classmethod
+    def age_factor(cls, tournament: Tournament, reckoning_day: datetime):
+        """ the age factor that weight_tournaments gives a tournament """
+        if tournament.end_date > reckoning_day:
+            return 0.0
+        if tournament.effective_end_date < cls.yearsPrior(2, reckoning_day):
+            return 0.0
+        if tournament.effective_end_date < cls.yearsPrior(1, reckoning_day):
+            return 0.5
+        return 1.0
+
+    def save_setting(self, key: str, value):
+        setting = self.db.query(Settings).filter_by(key=key).first()
+        if setting is None:
+            setting = Settings()
+            setting.key = key
+            self.db.add(setting)
+        setting.value = value
+
+    def live_reckoning_day(self):
+        """ the reckoning day that the ranks in the player table were
+        calculated for, or None if we don't know """
+        setting = self.db.query(Settings).filter_by(
+            key="reckoning_day").first()
+        return None if setting is None else \
+            datetime.fromisoformat(setting.value)
+
+    @classmethod
+    def age_factor_expression(cls, reckoning_day: datetime):
+        """ SQL expression for the age factor of a tournament on the given
+        reckoning day. Same rules as age_factor """
+        return case(
+            # this is for when we are retrospectively calculating historic quota
+            (Tournament.end_date > reckoning_day, 0.0),
+            (Tournament.effective_end_date < cls.yearsPrior(2, reckoning_day),
+             0.0),
+            (Tournament.effective_end_date < cls.yearsPrior(1, reckoning_day),
+             0.5),
+            else_=1.0,
+            )
+
     def weight_tournaments(self, reckoning_day: datetime):
         """For all tournaments, given reckoning day,
         age the tournament MERS weighting, and apply this aged MERS weighting
         to each tournament result"""
-        expiry_day = self.yearsPrior(2, reckoning_day)
-        halving_day = self.yearsPrior(1, reckoning_day)
-        self.db.execute(update(Tournament).
-            where(Tournament.effective_end_date < expiry_day).
-            values(age_factor = 0.0))
-        self.db.execute(update(Tournament).
-            where(Tournament.effective_end_date >= expiry_day).
-            where(Tournament.effective_end_date < halving_day).
-            values(age_factor = 0.5))
-        self.db.execute(update(Tournament).
-            where(Tournament.effective_end_date > halving_day).
-            values(age_factor = 1.0))
-
-        # this is for when we are retrospectively calculating historic quota
-        self.db.execute(update(Tournament).
-            where(Tournament.end_date > reckoning_day).
-            values(age_factor = 0.0))
+        self.db.execute(update(Tournament).values(
+            age_factor=self.age_factor_expression(reckoning_day)))
 
         # finally, weight all the results by the aged MERS factors
         self.db.execute(update(PlayerTournament).values(aged_mers =
             Tournament.age_factor * Tournament.mers).
             where(Tournament.id == PlayerTournament.tournament_id))
+        self.save_setting("reckoning_day", reckoning_day.isoformat())
         self.db.commit()
 
-    def rank_player(self, p):
+    def rank_at(self, reckoning_day: datetime) -> ranking_numpy.Snapshot:
+        """ rank every player on the given reckoning day, without writing
+        anything to the database. Unlike rank_all_players, the age factors
+        are calculated in the query, so the live ranking is left alone """
+        aged_mers = self.age_factor_expression(reckoning_day) * Tournament.mers
+        ranked = ranking_numpy.rank_results(
+            ranking_numpy.load_results(self.db, aged_mers))
+        return ranking_numpy.snapshot(
+            reckoning_day, *ranking_numpy.load_players(self.db), ranked)
+
+    def sweep(self, reckoning_days, save_history=False,
+              processes: int = None) -> dict:
+        """ rank every player on each of the given reckoning days, without
+        touching the live ranking. Returns a dict of reckoning_day: Snapshot.
+        Work is reused from one day to the next, so it's cheap to sweep
+        through many dates, e.g. every month for 10 years.
+        If processes is given, the players are split between that many
+        worker processes.
+        If save_history is set, the snapshots are saved in rank_history """
+        history = ranking_numpy.load_history(self.db)
+        player_ids, ema_players = ranking_numpy.load_players(self.db)
+        if processes:
+            histories, player_chunks = ranking_numpy.split_history(
+                history, player_ids, processes)
+            with ProcessPoolExecutor(processes) as pool:
+                sweeps = list(pool.map(
+                    ranking_numpy.sweep_ranks,
+                    histories,
+                    player_chunks,
+                    repeat(reckoning_days),
+                    ))
+            snapshots = ranking_numpy.sweep_snapshots(
+                ranking_numpy.merge_sweeps(sweeps), player_ids, ema_players)
+        else:
+            snapshots = ranking_numpy.sweep(
+                history, player_ids, ema_players, reckoning_days)
+        if save_history:
+            RankHistoryStore(self.db).save(list(snapshots.values()))
+        return snapshots
+
+    def live_snapshot(self) -> ranking_numpy.Snapshot:
+        """ the live ranking from the player table, as a Snapshot """
+        return ranking_numpy.live_snapshot(
+            self.db, self.live_reckoning_day())
+
+    def diff(self, old, new=None) -> RankingDiff:
+        """ compare two rankings. old and new can each be a reckoning day,
+        a Snapshot (e.g. a proposed ranking), or None for the live ranking.
+        Reckoning days, as a date or a datetime, are ranked together in one
+        sweep """
+        # a plain date is ranked as at the start of that day
+        old, new = (datetime.combine(d, datetime.min.time())
+                    if isinstance(d, date) and not isinstance(d, datetime)
+                    else d for d in (old, new))
+        days = [d for d in (old, new) if isinstance(d, datetime)]
+        snapshots = self.sweep(days) if days else {}
+        rankings = []
+        for ranking in (old, new):
+            if ranking is None:
+                ranking = self.live_snapshot()
+            elif isinstance(ranking, datetime):
+                ranking = snapshots[ranking]
+            rankings.append(ranking)
+        return RankingDiff(self.db, *rankings)
+
+    def rank_player(self, p, results=None):
         ''' calculate both MCR and riichi ranking for a given player '''
         # get all results with a non-zero weighting
-        results = [r for r in p.tournaments if r.aged_mers > 0]
+        if results is None:
+            results = [Result.from_row(r) for r in p.tournaments
+                       if r.aged_mers > 0]
         for ruleset in Ruleset:
             self.rank_one_player_for_one_ruleset(p, ruleset, results)
 
+    def load_result_rows(self, player_ids=None):
+        """ every result with a non-zero weighting, as plain
+        (base_rank, aged_mers, ruleset, tournament_id) tuples, grouped by
+        player. Returns a list of (player_id, results) """
+        query = select(
+            PlayerTournament.player_id,
+            PlayerTournament.base_rank,
+            PlayerTournament.aged_mers,
+            PlayerTournament.ruleset,
+            PlayerTournament.tournament_id,
+            ).where(PlayerTournament.aged_mers > 0).order_by(
+            PlayerTournament.player_id,
+            PlayerTournament.tournament_id,
+            )
+        if player_ids is not None:
+            query = query.where(PlayerTournament.player_id.in_(player_ids))
+        rows = self.db.execute(query).all()
+        return [(player_id, [tuple(r[1:]) for r in results])
+                for player_id, results in groupby(rows, key=itemgetter(0))]
+
 
     def rank_one_player_for_one_ruleset(self, player, ruleset, results=None):
-        """ this contains the main ranking algorithm """
+        """ rank one player for one ruleset, and save it on the Player """
         # do some argument-parsing to allow this function to be called in
         # different ways. This is very convenient during testing
         if type(player) == str:
             player = self.db.query(Player).filter_by(ema_id=player).first()
         if results is None:
-            results = [r for r in player.tournaments if r.aged_mers > 0]
+            results = [Result.from_row(r) for r in player.tournaments
+                       if r.aged_mers > 0]
 
         # filter results to only those for this ruleset
-        eligible = self.get_ranked_tournaments_for_player(
-            [r for r in results if r.ruleset == ruleset]
-            )
+        player.rank(ruleset, self.calculate_rank(
+            [r for r in results if r.ruleset == ruleset]))
+
+    @classmethod
+    def calculate_rank(cls, results, explanation: dict = None):
+        """ this contains the main ranking algorithm. Given one player's
+        weighted results for one ruleset, return their (unrounded) rank, or
+        None if they aren't eligible for a rank.
+        If an explanation dict is given, it's filled in with the breakdown
+        of the calculation, as stored in RankExplanation """
+        eligible = cls.get_ranked_tournaments_for_player(results)
 
         if eligible is None:
-            player.rank(ruleset, None)
-            return
+            return None
 
         # part A is a weighted average of all eligible results
         weights = [t.aged_mers for t in eligible]
         ranks = [round(t.base_rank) for t in eligible]
-        partA = self.weighted_average(ranks, weights)
+        partA = cls.weighted_average(ranks, weights)
 
         # part B is a weighted average of the top 4 results, ranked by base rank
         weights = [t.aged_mers for t in eligible[0:4]]
         ranks = [round(t.base_rank) for t in eligible[0:4]]
-        partB = self.weighted_average(ranks, weights)
+        partB = cls.weighted_average(ranks, weights)
+
+        if explanation is not None:
+            explanation.update({
+                "part_a": partA,
+                "part_b": partB,
+                "part_a_count": len(eligible),
+                "part_b_count": len(eligible[0:4]),
+                "padding": sum(r is PADDING for r in eligible),
+                "results": [[r.tournament_id, r.base_rank, r.aged_mers]
+                            for r in eligible if r is not PADDING],
+                })
 
         # final ranking is a straight average of part A and part B
-        player.rank(ruleset, 0.5 * partA + 0.5 * partB)
+        return 0.5 * partA + 0.5 * partB
 
-    def get_ranked_tournaments_for_player(self, results):
+    @staticmethod
+    def get_ranked_tournaments_for_player(results):
         """ given a list of results, return the ones that are eligible for
         ranking. If there are fewer than 2 eligible, then the player
         isn't eligible to have a ranking yet.
@@ -155,49 +358,369 @@ class PlayerRankingEngine:
         # sort the results in descending base_rank order (and by highest mers to break ties)
         results.sort(key=lambda s: -s.base_rank - s.aged_mers/1000)
         # pad the list to at least 5 results
-        while len(results) < 5:
-            results.append(PlayerTournament(
-                tournament_id=0,
-                aged_mers=1.0,
-                base_rank=0.0))
+        results.extend([PADDING] * (5 - len(results)))
 
         # cap the eligible number of results at 5 + 80% of the amount over 5
         number_eligible = ceil(5 + 0.8*max(len(results) - 5, 0))
         return results[0:number_eligible]
 
+    def rank_in_parallel(self, processes: int = None):
+        """ rank every player from their current aged_mers, splitting the
+        players into chunks that are ranked in a pool of worker processes,
+        then write all the ranks back in one bulk update.
+        The results are the same as the python engine's, whatever the
+        number of processes """
+        players = self.load_result_rows()
+
+        processes = processes or os.cpu_count()
+        size = ceil(len(players) / (processes * 4)) or 1
+        chunks = [players[i:i + size] for i in range(0, len(players), size)]
+        with ProcessPoolExecutor(processes) as pool:
+            ranked = merge_chunks(pool.map(rank_chunk, chunks))
+        ranking_numpy.write_ranks(self.db, ranked)
+
+    def rank_in_python(self) -> ranking_numpy.Snapshot:
+        """ rank everyone from their current aged_mers with the python
+        engine, without writing anything. Used to check the other engines """
+        ranked = merge_chunks([rank_chunk(self.load_result_rows())])
+        return ranking_numpy.snapshot(
+            self.live_reckoning_day(),
+            *ranking_numpy.load_players(self.db),
+            ranked,
+            )
+
+    def rank_in_sql(self):
+        """ rank every player from their current aged_mers entirely inside
+        the database, without loading any results into python.
+
+        Each player's results are numbered best first, and counted, with
+        window functions. Those within the top NA make part A, and the top 4
+        part B. Dummy results have base rank 0 and weight 1, so padding only
+        adds to the sum of the weights: 5 - PN for part A, 4 - PN for part B.
+
+        SQLite's SUM may add up in a different order from python, so ranks
+        can differ from the python engine in the last bit, which very
+        rarely changes the rounded rank; assess_player_ranking with the
+        python engine as reference checks for that """
+        pt = PlayerTournament
+        results = select(
+            pt.player_id,
+            pt.ruleset,
+            func.round(pt.base_rank).label("base_rank"),
+            pt.aged_mers,
+            func.row_number().over(
+                partition_by=(pt.player_id, pt.ruleset),
+                # same order as get_ranked_tournaments_for_player
+                order_by=(-pt.base_rank - pt.aged_mers / 1000,
+                          pt.tournament_id),
+                ).label("n"),
+            func.count().over(
+                partition_by=(pt.player_id, pt.ruleset)).label("pn"),
+            ).where(pt.aged_mers > 0).subquery()
+
+        # NA = ceil(5 + 0.8 * max(PN - 5, 0)), in integer arithmetic
+        pn = results.c.pn
+        number_eligible = 5 + (4 * func.max(pn - 5, 0) + 4) // 5
+        weighted = results.c.base_rank * results.c.aged_mers
+        in_part_b = results.c.n <= 4
+        count = func.min(pn)
+        part_a = func.sum(weighted) / (
+            func.sum(results.c.aged_mers) + func.max(5 - count, 0))
+        part_b = func.sum(case((in_part_b, weighted), else_=0.0)) / (
+            func.sum(case((in_part_b, results.c.aged_mers), else_=0.0)) +
+            func.max(4 - count, 0))
+        # python's round() takes exact halves to the even neighbour, where
+        # SQLite's ROUND takes them up. Ranks are never negative, so the
+        # CAST to integer is the floor
+        hundredths = (0.5 * part_a + 0.5 * part_b) * 100
+        floor = cast(hundredths, Integer)
+        rounded = case(
+            (hundredths - floor == 0.5, floor + floor % 2),
+            else_=func.round(hundredths))
+        ranks = select(
+            results.c.player_id,
+            results.c.ruleset,
+            (rounded / 100.0).label("rank"),
+            ).where(results.c.pn >= 2).where(
+            results.c.n <= number_eligible).group_by(
+            results.c.player_id, results.c.ruleset).subquery()
+
+        self.db.execute(update(Player).values(
+            mcr_rank=None, riichi_rank=None).execution_options(
+            synchronize_session=False))
+        for ruleset in Ruleset:
+            self.db.execute(update(Player).values(
+                {f"{ruleset.value}_rank": ranks.c.rank}).where(
+                Player.id == ranks.c.player_id).where(
+                ranks.c.ruleset == ruleset).execution_options(
+                synchronize_session=False))
+
     # TODO it would be nice to be able to do this for just one ruleset
-    def rank_all_players(self, reckoning_day:datetime = None, assess=False):
-        """ cycle through all players, and rank each in turn """
-        self.weight_tournaments(reckoning_day or datetime.now())
-        players = self.db.query(Player).all()
-        for p in players:
-            self.rank_player(p)
+    def rank_all_players(self, reckoning_day:datetime = None, assess=False,
+                         engine: str = "python", save_history=False,
+                         processes: int = None, explain=False):
+        """ cycle through all players, and rank each in turn.
+        engine "python" walks the Player objects one by one; engine "numpy"
+        ranks everyone at once from arrays (see ranking_numpy.py), and gives
+        identical ranks in a fraction of the time; engine "parallel" ranks
+        chunks of players in a pool of processes (see rank_in_parallel);
+        engine "sql" ranks everyone inside the database (see rank_in_sql),
+        and with assess also checks itself against the python engine.
+        If save_history is set, the ranking is also saved in rank_history.
+        If explain is set, everyone's RankExplanation is refreshed, and
+        otherwise they're all deleted, as they'd no longer be right """
+        if engine not in ENGINES:
+            raise ValueError(f"unknown ranking engine {engine}")
+        reckoning_day = reckoning_day or datetime.now()
+        self.weight_tournaments(reckoning_day)
+        if engine == "numpy":
+            ranking_numpy.write_ranks(self.db, ranking_numpy.rank_results(
+                ranking_numpy.load_results(self.db)))
+        elif engine == "parallel":
+            self.rank_in_parallel(processes)
+        elif engine == "sql":
+            self.rank_in_sql()
+        else:
+            with QueryCounter(self.db) as counter:
+                results = {player_id: [Result(*r) for r in rows]
+                           for player_id, rows in self.load_result_rows()}
+                for p in self.db.query(Player):
+                    self.rank_player(p, results.get(p.id, []))
+            logging.info(f"ranked all players in {counter.count} queries")
         self.db.commit()
         # now calculate each player's position in the rankings
         for rules in ('mcr', 'riichi'):
-            players = self.db.query(Player).filter(
-                        Player.ema_id != -1).filter(
-                        getattr(Player, f"{rules}_rank") != None).order_by(
-                        getattr(Player, f"{rules}_rank").desc()).all()
-            self.db.query(Settings).filter_by(
-                key=f"player_count_{rules}").update({"value": len(players)})
-            i = 1
-            for p in players:
-                setattr(p, f"{rules}_position", i)
-                i += 1
+            self.assign_positions(rules)
         self.db.commit()
 
+        if save_history:
+            RankHistoryStore(self.db).save_live(reckoning_day)
+
+        if explain:
+            self.save_explanations()
+        else:
+            self.forget_explanations()
+
         if assess:
             self.assess_player_ranking()
+            if engine == "sql":
+                # check the sql engine against the python engine too
+                self.assess_player_ranking(self.rank_in_python())
+
+    def assign_positions(self, rules: str):
+        """ set every player's position for one ruleset, with a single
+        set-based UPDATE, using a window function to number the ranks """
+        rank_column = getattr(Player, f"{rules}_rank")
+        ranked = select(
+            Player.id,
+            func.rank().over(order_by=rank_column.desc()).label("position"),
+            ).where(Player.ema_id != -1).where(rank_column != None).subquery()
+
+        self.db.execute(update(Player).values(
+            {f"{rules}_position": None}).execution_options(
+            synchronize_session=False))
+        self.db.execute(update(Player).values(
+            {f"{rules}_position": ranked.c.position}).where(
+            Player.id == ranked.c.id).execution_options(
+            synchronize_session=False))
+        self.save_setting(f"player_count_{rules}", self.db.scalar(
+            select(func.count()).select_from(ranked)))
+
+    def rank_tournament_players(self, tournament: Tournament,
+                                previous_player_ids=(), verify=False,
+                                explain=False):
+        """ after a tournament has been added or changed, re-rank just the
+        players who played in it, instead of everyone. previous_player_ids
+        are players who were in the tournament results before it changed.
+
+        The tournament is aged to the same reckoning day as the live ranking,
+        and positions are repaired by merging the re-ranked players back into
+        the existing order, so only positions that moved are written """
+        reckoning_day = self.live_reckoning_day()
+        if reckoning_day is None:
+            logging.warning("no live reckoning day on file, so ranking all "
+                            "players instead")
+            self.rank_all_players()
+            return
+
+        tournament.age_factor = self.age_factor(tournament, reckoning_day)
+        self.db.execute(update(PlayerTournament).values(
+            aged_mers=tournament.age_factor * (tournament.mers or 0)).where(
+            PlayerTournament.tournament_id == tournament.id))
+
+        player_ids = set(previous_player_ids)
+        player_ids.update(self.db.scalars(select(
+            PlayerTournament.player_id).where(
+            PlayerTournament.tournament_id == tournament.id)))
+        players = load_players(self.db, self.db.query(Player).filter(
+            Player.id.in_(player_ids)), tournaments=False)
+        for p in players:
+            self.rank_player(p)
+
+        for rules in ('mcr', 'riichi'):
+            self.repair_positions(rules, players)
+        self.db.commit()
+
+        if explain:
+            self.save_explanations(player_ids)
+        else:
+            self.forget_explanations(player_ids)
+
+        if verify:
+            self.verify_live_ranking()
+
+    def repair_positions(self, rules: str, players):
+        """ re-position the given players, who have just been re-ranked,
+        among everybody else, whose ranks haven't changed """
+        rank_column = getattr(Player, f"{rules}_rank")
+        position_column = getattr(Player, f"{rules}_position")
+        moved = {p.id for p in players}
+        others = [row for row in self.db.execute(select(
+            Player.id, rank_column, position_column).where(
+            Player.ema_id != -1).where(rank_column != None).where(
+            position_column != None).order_by(position_column))
+            if row[0] not in moved]
+        old_positions = {row[0]: row[2] for row in others}
+
+        # others are already in descending rank order, so we only need to
+        # find where each moved player slots in
+        keys = [-row[1] for row in others]
+        ranking = [row[0] for row in others]
+        for p in players:
+            rank = getattr(p, f"{rules}_rank")
+            old_positions[p.id] = getattr(p, f"{rules}_position")
+            if rank is None or p.ema_id in (None, "-1"):
+                setattr(p, f"{rules}_position", None)
+                continue
+            idx = bisect_right(keys, -rank)
+            keys.insert(idx, -rank)
+            ranking.insert(idx, p.id)
+
+        self.db.flush()
+        changes = []
+        for i, (key, pid) in enumerate(zip(keys, ranking)):
+            # tied ranks share a position
+            if i == 0 or key != keys[i - 1]:
+                position = i + 1
+            if old_positions[pid] != position:
+                changes.append({"id": pid, f"{rules}_position": position})
+        if changes:
+            self.db.execute(update(Player), changes)
+        self.save_setting(f"player_count_{rules}", len(ranking))
+
+    def save_explanations(self, player_ids=None):
+        """ work out how each player's live rank was calculated, and save it
+        as their RankExplanation, replacing the old one. Just for the given
+        players, or for everyone """
+        reckoning_day = self.live_reckoning_day()
+        rows = []
+        for player_id, results in self.load_result_rows(player_ids):
+            results = [Result(*r) for r in results]
+            for ruleset in Ruleset:
+                explanation = {}
+                rank = self.calculate_rank(
+                    [r for r in results if r.ruleset == ruleset], explanation)
+                if rank is None:
+                    continue
+                explanation.update({
+                    "player_id": player_id,
+                    "ruleset": ruleset,
+                    "reckoning_day": reckoning_day,
+                    "rank": round(rank * 100) / 100,
+                    })
+                rows.append(explanation)
+
+        self.forget_explanations(player_ids, commit=False)
+        if rows:
+            self.db.execute(insert(RankExplanation.__table__), rows)
+        self.db.commit()
 
-    def assess_player_ranking(self):
+    def forget_explanations(self, player_ids=None, commit=True):
+        """ delete the RankExplanation of the given players, or everyone's,
+        when they've been re-ranked without one """
+        query = delete(RankExplanation)
+        if player_ids is not None:
+            query = query.where(RankExplanation.player_id.in_(player_ids))
+        self.db.execute(query)
+        if commit:
+            self.db.commit()
+
+    def why(self, player, ruleset: Ruleset) -> str:
+        """ explain a player's rank, from their saved RankExplanation.
+        player can be a Player or an EMA id """
+        if type(player) == str:
+            player = self.db.query(Player).filter_by(ema_id=player).first()
+        e = self.db.get(RankExplanation, (player.id, ruleset))
+        if e is None:
+            return (f"{player.calling_name} has no {ruleset.value} rank "
+                    "explanation on file")
+        lines = [f"{player.calling_name}: {ruleset.value} rank {e.rank} "
+                 f"on {e.reckoning_day:%Y-%m-%d}",
+                 f"Part A {round(e.part_a, 2)} = weighted average of the best "
+                 f"{e.part_a_count} results",
+                 f"Part B {round(e.part_b, 2)} = weighted average of the best "
+                 f"{e.part_b_count} results"]
+        titles = dict(self.db.query(Tournament.id, Tournament.title).filter(
+            Tournament.id.in_([r[0] for r in e.results])))
+        for i, (tournament_id, base_rank, weight) in enumerate(e.results):
+            parts = "A+B" if i < e.part_b_count else "A"
+            lines.append(f"  {parts}: {base_rank} x {weight} "
+                         f"{titles.get(tournament_id, tournament_id)}")
+        if e.padding:
+            lines.append(f"  plus {e.padding} dummy results of 0 x 1.0, as "
+                         "there were fewer than 5 results")
+        return "\n".join(lines)
+
+    def verify_live_ranking(self) -> int:
+        """ check the ranks and positions in the player table against a
+        full recompute from the current aged weightings. Logs and returns
+        the number of mismatches """
+        bad = 0
+        ranked = ranking_numpy.rank_results(
+            ranking_numpy.load_results(self.db))
+        for ruleset, (player_ids, ranks) in ranked.items():
+            rules = ruleset.value
+            expected = dict(zip(player_ids.tolist(), ranks.tolist()))
+            positioned = []
+            for pid, rank, position, ema_id in self.db.execute(select(
+                    Player.id,
+                    getattr(Player, f"{rules}_rank"),
+                    getattr(Player, f"{rules}_position"),
+                    Player.ema_id)):
+                if rank != expected.get(pid):
+                    bad += 1
+                    logging.warning(f"player {pid} has {rules} rank {rank}, "
+                                    f"but full recompute gives "
+                                    f"{expected.get(pid)}")
+                if rank is not None and ema_id not in (None, "-1"):
+                    positioned.append((position or 0, -rank, pid))
+
+            # positions must follow descending rank order, with ties sharing
+            positioned.sort(key=lambda x: x[1])
+            for i, (position, rank, pid) in enumerate(positioned):
+                if i == 0 or rank != positioned[i - 1][1]:
+                    expected_position = i + 1
+                if position != expected_position:
+                    bad += 1
+                    logging.warning(f"player {pid} has {rules} position "
+                                    f"{position}, but should be "
+                                    f"{expected_position}")
+        logging.info(f"live ranking verified, {bad} mismatches")
+        return bad
+
+    def assess_player_ranking(self, reference=None):
+        """ compare our ranks with the official ones scraped from the EMA
+        site or, if a reference Snapshot is given, with that """
         total = 0
         bad = 0
         acceptable = 0.02
         for p in self.db.query(Player).all():
             total +=1
             for rules in ("mcr", "riichi"):
-                official = getattr(p, f"{rules}_official_rank")
+                if reference is None:
+                    official = getattr(p, f"{rules}_official_rank")
+                else:
+                    official = reference.rank(p.id, Ruleset[rules])
                 ours = getattr(p, f"{rules}_rank")
                 if (official is None and ours is not None) or (
                         official is not None and ours is None):
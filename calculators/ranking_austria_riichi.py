@@ -29,6 +29,7 @@ from math import ceil
 from sqlalchemy import update
 
 from models import Player, Tournament, PlayerTournament, Settings
+from utils.loaders import load_players
 
 class PlayerRankingEngine:
     def __init__(self, db):
@@ -45,7 +46,8 @@ class PlayerRankingEngine:
 
     def rank_all_players(self, quota_start:datetime = None, quota_end:datetime = None, assess=False):
         """ cycle through all players, and rank each in turn """
-        players = self.db.query(Player).filter(Player.country_id == 'at').all()
+        players = load_players(
+            self.db, self.db.query(Player).filter(Player.country_id == 'at'))
         players_tourneys=[]
         for p in players :
             aut_tourneys=[r for r in p.tournaments if r.ruleset.name == 'riichi' and r.was_ema and r.tournament.country_id == 'at' and r.tournament.end_date >= quota_start and r.tournament.start_date <= quota_end]
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+'''
+Compare two rankings, e.g. last month's against this month's, or the live
+ranking against a proposed one, and report who entered or left the ranking,
+and how far everyone else's rank and position moved.
+
+The comparison is done in one pass over the two rank vectors. The rows can
+be streamed to CSV or JSON lines, for the national organisations'
+newsletters.
+'''
+import csv
+import json
+
+import numpy as np
+
+from models import Player, Ruleset
+from calculators.ranking_numpy import Snapshot, RULESETS
+
+FIELDS = ("ruleset", "change", "player_id", "ema_id", "name", "country",
+          "old_rank", "new_rank", "rank_delta",
+          "old_position", "new_position", "position_delta")
+
+
+def _align(snapshot: Snapshot, player_ids):
+    """ ranks and positions of the snapshot, re-indexed to player_ids.
+    An empty snapshot, e.g. from before the first tournament, has no one
+    ranked """
+    if len(snapshot.player_ids) == 0:
+        return ({r: np.full(len(player_ids), np.nan) for r in RULESETS},
+                {r: np.zeros(len(player_ids), dtype=np.int64)
+                 for r in RULESETS})
+    idx = np.searchsorted(snapshot.player_ids, player_ids)
+    idx = np.minimum(idx, len(snapshot.player_ids) - 1)
+    found = snapshot.player_ids[idx] == player_ids
+    ranks = {r: np.where(found, snapshot.ranks[r][idx], np.nan)
+             for r in RULESETS}
+    positions = {r: np.where(found, snapshot.positions[r][idx], 0)
+                 for r in RULESETS}
+    return ranks, positions
+
+
+class RankingDiff:
+    """ the differences between an old and a new ranking. Only players who
+    have a position (i.e. EMA players with a rank) in either ranking are
+    included.
+    change is one of "entry", "exit", "moved" or "unchanged".
+    rank_delta is new rank - old rank, and position_delta is old position -
+    new position, so both are positive when a player moves up """
+    def __init__(self, db, old: Snapshot, new: Snapshot):
+        self.db = db
+        self.old = old
+        self.new = new
+        self.player_ids = np.union1d(old.player_ids, new.player_ids).astype(
+            np.int64)
+        self.old_ranks, self.old_positions = _align(old, self.player_ids)
+        self.new_ranks, self.new_positions = _align(new, self.player_ids)
+
+        self.changes = {}
+        for r in RULESETS:
+            was = self.old_positions[r] > 0
+            now = self.new_positions[r] > 0
+            change = np.full(len(self.player_ids), "", dtype=object)
+            change[now & ~was] = "entry"
+            change[was & ~now] = "exit"
+            both = was & now
+            moved = both & (
+                (self.old_ranks[r] != self.new_ranks[r]) |
+                (self.old_positions[r] != self.new_positions[r]))
+            change[moved] = "moved"
+            change[both & ~moved] = "unchanged"
+            self.changes[r] = change
+
+    def summary(self) -> dict:
+        """ number of players per ruleset and type of change """
+        return {r: {change: int(np.count_nonzero(self.changes[r] == change))
+                    for change in ("entry", "exit", "moved", "unchanged")}
+                for r in RULESETS}
+
+    def _shown(self, ruleset: Ruleset, unchanged: bool):
+        shown = self.changes[ruleset] != ""
+        if not unchanged:
+            shown &= self.changes[ruleset] != "unchanged"
+        return shown
+
+    def rows(self, ruleset: Ruleset = None, unchanged=False):
+        """ generate one dict per changed player, ordered by ruleset, then
+        new position (with exits last) """
+        players = {row[0]: row[1:] for row in self.db.query(
+            Player.id, Player.ema_id, Player.calling_name, Player.country_id)}
+        for r in RULESETS if ruleset is None else [ruleset]:
+            change = self.changes[r]
+            idx = np.flatnonzero(self._shown(r, unchanged))
+            # exits have new position 0, so put them after everyone else
+            new_positions = self.new_positions[r][idx]
+            order = np.lexsort((self.old_positions[r][idx],
+                                np.where(new_positions == 0, np.iinfo(
+                                    np.int64).max, new_positions)))
+            for i in idx[order]:
+                ema_id, name, country = players.get(
+                    int(self.player_ids[i]), (None, None, None))
+                old_rank = self.old_ranks[r][i]
+                new_rank = self.new_ranks[r][i]
+                old_position = int(self.old_positions[r][i]) or None
+                new_position = int(self.new_positions[r][i]) or None
+                yield {
+                    "ruleset": r.value,
+                    "change": change[i],
+                    "player_id": int(self.player_ids[i]),
+                    "ema_id": ema_id,
+                    "name": name,
+                    "country": country,
+                    "old_rank": None if np.isnan(old_rank)
+                        else float(old_rank),
+                    "new_rank": None if np.isnan(new_rank)
+                        else float(new_rank),
+                    "rank_delta": None
+                        if np.isnan(old_rank) or np.isnan(new_rank)
+                        else round(float(new_rank - old_rank), 2),
+                    "old_position": old_position,
+                    "new_position": new_position,
+                    "position_delta": None
+                        if old_position is None or new_position is None
+                        else old_position - new_position,
+                    }
+
+    def write_csv(self, file, ruleset: Ruleset = None, unchanged=False):
+        """ stream the rows to an open text file, as CSV """
+        writer = csv.DictWriter(file, fieldnames=FIELDS)
+        writer.writeheader()
+        for row in self.rows(ruleset, unchanged):
+            writer.writerow(row)
+
+    def write_json(self, file, ruleset: Ruleset = None, unchanged=False):
+        """ stream the rows to an open text file, as JSON lines """
+        for row in self.rows(ruleset, unchanged):
+            file.write(json.dumps(row) + "\n")
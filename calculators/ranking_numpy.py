@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+'''
+Vectorised version of the EMA ranking calculation in ranking.py
+
+Instead of walking every Player and their PlayerTournament objects, all the
+results that currently carry weight are pulled from the database in one
+query, and the top-N selection, padding, and both weighted averages are
+calculated for every player at once, with numpy arrays.
+
+The arithmetic is done in the same order as the python engine, so that the
+ranks come out bit-identical, not just close.
+'''
+import sys
+from datetime import date, datetime
+
+import numpy as np
+from sqlalchemy import select, update
+
+from models import Player, PlayerTournament, Ruleset, Tournament
+
+RULESETS = tuple(Ruleset)
+
+# from python 3.12, the builtin sum() of floats uses Neumaier compensated
+# summation. We must do the same to match PlayerRankingEngine.weighted_average
+COMPENSATED_SUM = sys.version_info >= (3, 12)
+
+
+def load_results(db, aged_mers=PlayerTournament.aged_mers):
+    """ get every result with a non-zero aged_mers weighting, as arrays.
+    By default the weighting is the one stored by weight_tournaments, but
+    any SQL expression over the result and its tournament can be given.
+    Rows are ordered by player, then by tournament, which is the order the
+    python engine sees them in """
+    rows = db.execute(select(
+        PlayerTournament.player_id,
+        PlayerTournament.ruleset,
+        PlayerTournament.base_rank,
+        aged_mers,
+        ).join(Tournament).where(aged_mers > 0).order_by(
+        PlayerTournament.player_id,
+        PlayerTournament.tournament_id,
+        )).all()
+    return {
+        "player_id": np.array([r[0] for r in rows], dtype=np.int64),
+        "ruleset": np.array(
+            [RULESETS.index(r[1]) for r in rows], dtype=np.int8),
+        "base_rank": np.array([r[2] for r in rows], dtype=np.float64),
+        "aged_mers": np.array([r[3] for r in rows], dtype=np.float64),
+        }
+
+
+def load_players(db):
+    """ the sorted array of all player ids, and a boolean array of which of
+    them are EMA players, and so eligible for a position """
+    players = db.execute(select(Player.id, Player.ema_id).order_by(
+        Player.id)).all()
+    return (
+        np.array([p[0] for p in players], dtype=np.int64),
+        np.array([p[1] not in (None, "-1") for p in players], dtype=bool),
+        )
+
+
+def load_history(db):
+    """ get every result, with the tournament dates and MERS needed to age
+    them on any reckoning day. Nothing is written to the database """
+    rows = db.execute(select(
+        PlayerTournament.player_id,
+        PlayerTournament.ruleset,
+        PlayerTournament.base_rank,
+        Tournament.mers,
+        Tournament.effective_end_date,
+        Tournament.end_date,
+        ).join(Tournament).order_by(
+        PlayerTournament.player_id,
+        PlayerTournament.tournament_id,
+        )).all()
+    return {
+        "player_id": np.array([r[0] for r in rows], dtype=np.int64),
+        "ruleset": np.array(
+            [RULESETS.index(r[1]) for r in rows], dtype=np.int8),
+        "base_rank": np.array([r[2] for r in rows], dtype=np.float64),
+        "mers": np.array([r[3] or 0 for r in rows], dtype=np.float64),
+        "effective_end_date": np.array(
+            [r[4] for r in rows], dtype="datetime64[us]"),
+        "end_date": np.array([r[5] for r in rows], dtype="datetime64[us]"),
+        }
+
+
+def _years_prior(years: int, to_date: datetime) -> np.datetime64:
+    # same as PlayerRankingEngine.yearsPrior
+    return np.datetime64(to_date + (
+        date(to_date.year - years, 1, 1) - date(to_date.year, 1, 1)), "us")
+
+
+def aged_mers(history, reckoning_day: datetime):
+    """ the aged MERS weighting of every result in the history, on the given
+    reckoning day. This is what weight_tournaments writes to the database """
+    expiry_day = _years_prior(2, reckoning_day)
+    halving_day = _years_prior(1, reckoning_day)
+    effective = history["effective_end_date"]
+    age_factor = np.where(effective < expiry_day, 0.0,
+                          np.where(effective < halving_day, 0.5, 1.0))
+    # tournaments after a retrospective reckoning day don't count yet
+    age_factor[history["end_date"] > np.datetime64(reckoning_day, "us")] = 0
+    return age_factor * history["mers"]
+
+
+def _add(total, compensation, x, active):
+    """ add column x onto the running totals, for the active rows only """
+    if COMPENSATED_SUM:
+        t = total + x
+        compensation += np.where(active, np.where(
+            np.abs(total) >= np.abs(x),
+            (total - t) + x,
+            (x - t) + total), 0.0)
+        total[:] = np.where(active, t, total)
+    else:
+        total[:] = np.where(active, total + x, total)
+
+
+def _finish(total, compensation):
+    if COMPENSATED_SUM:
+        return np.where(compensation != 0, total + compensation, total)
+    return total
+
+
+def rank_one_ruleset(player_id, base_rank, aged_mers):
+    """ given the results for one ruleset, return the ids of the players
+    who have a rank, and their (unrounded) ranks """
+    # sort by player, then by descending base_rank (and by highest mers to
+    # break ties), exactly as get_ranked_tournaments_for_player does
+    order = np.lexsort((-base_rank - aged_mers / 1000, player_id))
+    player_id = player_id[order]
+    ranks = np.round(base_rank[order])
+    weights = aged_mers[order]
+
+    players, starts, counts = np.unique(
+        player_id, return_index=True, return_counts=True)
+    # need two results to have a ranking
+    eligible = counts >= 2
+    players = players[eligible]
+    starts = starts[eligible]
+    counts = counts[eligible]
+    if not len(players):
+        return players, np.zeros(0)
+
+    # pad to 5 results, then cap the number counted in part A
+    padded = np.maximum(counts, 5)
+    number_eligible = np.ceil(
+        5 + 0.8 * np.maximum(padded - 5, 0)).astype(np.int64)
+
+    # running totals of rank*weight and of weight, and their compensations,
+    # for part A (all counted results) and part B (the best 4)
+    sums = {part: [np.zeros(len(players)) for _ in range(4)]
+            for part in "AB"}
+    everyone = np.ones(len(players), dtype=bool)
+    for slot in range(number_eligible.max()):
+        is_result = slot < counts
+        idx = np.where(is_result, starts + slot, 0)
+        # dummy padding results have base rank 0, weight 1
+        slot_weight = np.where(is_result, weights[idx], 1.0)
+        product = np.where(is_result, ranks[idx], 0.0) * slot_weight
+        counted = {"A": slot < number_eligible}
+        if slot < 4:
+            counted["B"] = everyone
+        for part, active in counted.items():
+            rank_total, rank_c, weight_total, weight_c = sums[part]
+            _add(rank_total, rank_c, product, active)
+            _add(weight_total, weight_c, slot_weight, active)
+
+    parts = {}
+    for part in "AB":
+        rank_total, rank_c, weight_total, weight_c = sums[part]
+        parts[part] = _finish(rank_total, rank_c) / \
+            _finish(weight_total, weight_c)
+    return players, 0.5 * parts["A"] + 0.5 * parts["B"]
+
+
+def rank_results(results):
+    """ rank every player in both rulesets. Returns a dict of
+    ruleset: (player ids, ranks) with ranks rounded as Player.rank does """
+    ranked = {}
+    for code, ruleset in enumerate(RULESETS):
+        mask = results["ruleset"] == code
+        players, ranks = rank_one_ruleset(
+            results["player_id"][mask],
+            results["base_rank"][mask],
+            results["aged_mers"][mask],
+            )
+        ranked[ruleset] = (players, np.rint(ranks * 100) / 100)
+    return ranked
+
+
+def write_ranks(db, ranked):
+    """ write ranks to the player table, with a bulk update. ranked is a
+    dict of ruleset: (player ids, ranks), as returned by rank_results.
+    Players without a rank in a ruleset are set to None """
+    db.execute(update(Player).values(mcr_rank=None, riichi_rank=None))
+    for ruleset, (players, ranks) in ranked.items():
+        column = f"{ruleset.value}_rank"
+        if len(players):
+            db.execute(update(Player), [
+                {"id": int(pid), column: float(rank)}
+                for pid, rank in zip(players, ranks)
+                ])
+
+
+class Snapshot:
+    """ the ranks and positions of every player on one reckoning day.
+    ranks[ruleset] is aligned with player_ids, and holds nan where the player
+    has no rank. positions[ruleset] holds 0 where the player has no position
+    (unranked, or not an EMA player) """
+    def __init__(self, reckoning_day, player_ids, ranks, positions):
+        self.reckoning_day = reckoning_day
+        self.player_ids = player_ids
+        self.ranks = ranks
+        self.positions = positions
+
+    def _index(self, player_id: int) -> int:
+        idx = np.searchsorted(self.player_ids, player_id)
+        if idx == len(self.player_ids) or self.player_ids[idx] != player_id:
+            raise KeyError(player_id)
+        return idx
+
+    def rank(self, player_id: int, ruleset: Ruleset):
+        rank = self.ranks[ruleset][self._index(player_id)]
+        return None if np.isnan(rank) else float(rank)
+
+    def position(self, player_id: int, ruleset: Ruleset):
+        position = self.positions[ruleset][self._index(player_id)]
+        return None if position == 0 else int(position)
+
+    def player_count(self, ruleset: Ruleset) -> int:
+        """ number of EMA players with a position """
+        return int(np.count_nonzero(self.positions[ruleset]))
+
+    def ranked(self, ruleset: Ruleset):
+        """ (player_id, rank, position) for every positioned player,
+        best first """
+        positions = self.positions[ruleset]
+        idx = np.flatnonzero(positions)
+        idx = idx[np.argsort(positions[idx], kind="stable")]
+        for i in idx:
+            yield (int(self.player_ids[i]), float(self.ranks[ruleset][i]),
+                   int(positions[i]))
+
+
+def live_snapshot(db, reckoning_day=None) -> Snapshot:
+    """ the live ranking, as stored in the player table """
+    ranks = {}
+    positions = {}
+    for ruleset in RULESETS:
+        rows = db.execute(select(
+            Player.id,
+            getattr(Player, f"{ruleset.value}_rank"),
+            getattr(Player, f"{ruleset.value}_position"),
+            ).order_by(Player.id)).all()
+        player_ids = np.array([r[0] for r in rows], dtype=np.int64)
+        ranks[ruleset] = np.array(
+            [np.nan if r[1] is None else r[1] for r in rows])
+        # unranked players may have an old position left over
+        positions[ruleset] = np.array(
+            [0 if r[1] is None else r[2] or 0 for r in rows], dtype=np.int64)
+    return Snapshot(reckoning_day, player_ids, ranks, positions)
+
+
+def positions_from_ranks(ranks, has_position):
+    """ positions in descending rank order, for players with a rank who are
+    eligible for a position. Tied ranks share a position, as the Position
+    rule in the comments at the top of ranking.py says. Everyone else gets 0
+    """
+    positions = np.zeros(len(ranks), dtype=np.int64)
+    eligible = np.flatnonzero(has_position & ~np.isnan(ranks))
+    keys = -ranks[eligible]
+    positions[eligible] = np.searchsorted(np.sort(keys), keys) + 1
+    return positions
+
+
+def snapshot(reckoning_day, player_ids, ema_players, ranked) -> Snapshot:
+    """ make a Snapshot from the output of rank_results """
+    ranks = {}
+    for ruleset, (players, player_ranks) in ranked.items():
+        ranks[ruleset] = np.full(len(player_ids), np.nan)
+        ranks[ruleset][np.searchsorted(player_ids, players)] = player_ranks
+    return Snapshot(
+        reckoning_day,
+        player_ids,
+        ranks,
+        {r: positions_from_ranks(ranks[r], ema_players) for r in RULESETS},
+        )
+
+
+def sweep_ranks(history, player_ids, reckoning_days):
+    """ rank everyone on each of the reckoning days. Returns a dict of
+    reckoning_day: {ruleset: ranks}, with ranks aligned with player_ids.
+    Only the players who have a result whose weighting changed since the
+    previous day are re-ranked, as nobody else's rank can have moved """
+    sweep = {}
+    row_player = np.searchsorted(player_ids, history["player_id"])
+    ranks = {r: np.full(len(player_ids), np.nan) for r in RULESETS}
+    previous = None
+    for day in sorted(reckoning_days):
+        weights = aged_mers(history, day)
+        if previous is None:
+            changed = np.ones(len(player_ids), dtype=bool)
+        else:
+            changed = np.zeros(len(player_ids), dtype=bool)
+            changed[row_player[weights != previous]] = True
+        previous = weights
+
+        rows = changed[row_player] & (weights > 0)
+        for code, ruleset in enumerate(RULESETS):
+            ranks[ruleset][changed] = np.nan
+            mask = rows & (history["ruleset"] == code)
+            players, new_ranks = rank_one_ruleset(
+                history["player_id"][mask],
+                history["base_rank"][mask],
+                weights[mask],
+                )
+            ranks[ruleset][np.searchsorted(player_ids, players)] = \
+                np.rint(new_ranks * 100) / 100
+        sweep[day] = {r: ranks[r].copy() for r in RULESETS}
+    return sweep
+
+
+def split_history(history, player_ids, chunks: int):
+    """ split the history and player ids into chunks of whole players, for
+    ranking in parallel """
+    player_chunks = np.array_split(player_ids, chunks)
+    row_chunks = []
+    for chunk in player_chunks:
+        if not len(chunk):
+            continue
+        start, end = (
+            np.searchsorted(history["player_id"], chunk[0], side="left"),
+            np.searchsorted(history["player_id"], chunk[-1], side="right"),
+            )
+        row_chunks.append({k: v[start:end] for k, v in history.items()})
+    return row_chunks, [c for c in player_chunks if len(c)]
+
+
+def merge_sweeps(sweeps):
+    """ join the outputs of sweep_ranks for consecutive chunks of players """
+    return {day: {r: np.concatenate([sweep[day][r] for sweep in sweeps])
+                  for r in RULESETS}
+            for day in sweeps[0]}
+
+
+def sweep_snapshots(sweep, player_ids, ema_players) -> dict:
+    """ turn the output of sweep_ranks into a dict of reckoning_day: Snapshot,
+    by working out everyone's positions """
+    return {day: Snapshot(
+        day,
+        player_ids,
+        ranks,
+        {r: positions_from_ranks(ranks[r], ema_players) for r in RULESETS},
+        ) for day, ranks in sweep.items()}
+
+
+def sweep(history, player_ids, ema_players, reckoning_days):
+    """ rank everyone on each of the reckoning days, and return a dict of
+    reckoning_day: Snapshot.
+    player_ids is the sorted array of all player ids, and ema_players the
+    boolean array of which of these are eligible for a position """
+    return sweep_snapshots(
+        sweep_ranks(history, player_ids, reckoning_days),
+        player_ids,
+        ema_players,
+        )
@@ -1,3 +1,4 @@
 from pathlib import Path
 DBPATH = 'sqlite:///d:\\zaps\\emarebuild\\ema.sqlite3'
 HTMLPATH = Path('d:\\zaps\\emarebuild\\html')
+CACHEPATH = Path('d:\\zaps\\emarebuild\\cache')
@@ -2,7 +2,7 @@ from datetime import datetime
 from enum import Enum as PyEnum
 from typing import Optional, List
 
-from sqlalchemy import Enum, ForeignKey
+from sqlalchemy import Enum, ForeignKey, Index, JSON
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 from sqlalchemy.types import String
 
@@ -165,9 +165,135 @@ class Tournament(Base):
     player_count: Mapped[int]
     ema_country_count: Mapped[Optional[int]]
     scraped_on: Mapped[Optional[datetime]]
+    # SHA-256 of the tournament page when it was scraped, so an incremental
+    # scrape can skip it if it hasn't changed
+    page_hash: Mapped[Optional[str]]
     age_factor: Mapped[Optional[float]]
 
     country_id: Mapped[Optional[str]] = mapped_column(ForeignKey("country.id"))
     country: Mapped[Optional[Country]] = relationship(back_populates="tournaments")
     players: Mapped[List[PlayerTournament]] = relationship(
         back_populates="tournament")
+
+
+class RankHistory(Base):
+    ''' a player's rank and position on one reckoning day. Written in bulk
+    by the ranking engine, so that historic rankings can be looked up instead
+    of recalculated '''
+    __tablename__ = "rank_history"
+    reckoning_day: Mapped[datetime] = mapped_column(primary_key=True)
+    ruleset: Mapped[Ruleset] = mapped_column(Enum(Ruleset), primary_key=True)
+    player_id: Mapped[int] = mapped_column(
+        ForeignKey("player.id"), primary_key=True)
+    rank: Mapped[float]
+    # None for players without an EMA id
+    position: Mapped[Optional[int]]
+
+    __table_args__ = (
+        # for "top N on date D"
+        Index("ix_rank_history_position",
+              "reckoning_day", "ruleset", "position"),
+        # for a player's rank on a date, and their rank trajectory
+        Index("ix_rank_history_player",
+              "player_id", "ruleset", "reckoning_day"),
+        )
+
+
+class CountryRankHistory(Base):
+    ''' a country's ranking on one reckoning day, e.g. a quota cutoff date,
+    so federations can follow how their position evolved '''
+    __tablename__ = "country_rank_history"
+    reckoning_day: Mapped[datetime] = mapped_column(primary_key=True)
+    ruleset: Mapped[Ruleset] = mapped_column(Enum(Ruleset), primary_key=True)
+    country_id: Mapped[str] = mapped_column(
+        ForeignKey("country.id"), primary_key=True)
+    # None for countries without any ranked players
+    position: Mapped[Optional[int]]
+    player_count: Mapped[int]
+    over700: Mapped[int]
+    average_rank_of_top3_players: Mapped[Optional[float]]
+
+    __table_args__ = (
+        # for a country's ranking over time
+        Index("ix_country_rank_history_country",
+              "country_id", "ruleset", "reckoning_day"),
+        )
+
+
+class RankExplanation(Base):
+    ''' how a player's rank in one ruleset was calculated. Rewritten
+    whenever the ranking engine re-ranks that player with explain=True, and
+    deleted when it re-ranks them without, so it's never out of date '''
+    __tablename__ = "rank_explanation"
+    player_id: Mapped[int] = mapped_column(
+        ForeignKey("player.id"), primary_key=True)
+    ruleset: Mapped[Ruleset] = mapped_column(Enum(Ruleset), primary_key=True)
+    reckoning_day: Mapped[Optional[datetime]]
+    rank: Mapped[float]
+    part_a: Mapped[float]
+    part_b: Mapped[float]
+    # NA and NB in the ranking algorithm
+    part_a_count: Mapped[int]
+    part_b_count: Mapped[int]
+    # number of dummy results (base rank 0, weight 1) added to make up 5
+    padding: Mapped[int]
+    # [tournament_id, base_rank, aged_mers] for each real result counted,
+    # best first. Part A counts the first part_a_count results (including
+    # padding, which comes last), part B the first part_b_count
+    results: Mapped[list] = mapped_column(JSON)
+
+
+class QuotaRun(Base):
+    ''' one run of the quota calculation, for an event such as a WRC, with
+    the totals that went into it. Kept, rather than overwritten, so earlier
+    runs can still be looked at '''
+    __tablename__ = "quota_run"
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    event: Mapped[Optional[str]]
+    ruleset: Mapped[Ruleset] = mapped_column(Enum(Ruleset))
+    total: Mapped[int]
+    # None if the quotas were made from the live ranking as it stood
+    cutoff_date: Mapped[Optional[datetime]]
+    # the reckoning day of the player ranking that the quotas came from
+    reckoning_day: Mapped[Optional[datetime]]
+    calculated: Mapped[datetime]
+    player_count: Mapped[int]
+    over700_count: Mapped[int]
+    # the average rank, above which players count towards a country's cap
+    average: Mapped[float]
+    unallocated: Mapped[int]
+    # [scalar, country_id, [tied country_ids]] for Part B seats decided by
+    # the country ranking
+    collisions: Mapped[list] = mapped_column(JSON)
+
+    allocations: Mapped[List["QuotaAllocation"]] = relationship(
+        back_populates="run",
+        order_by="QuotaAllocation.position",
+        cascade="all, delete-orphan",
+        )
+
+    __table_args__ = (
+        Index("ix_quota_run_event",
+              "event", "ruleset", "total", "cutoff_date"),
+        )
+
+
+class QuotaAllocation(Base):
+    ''' one country's seats in a QuotaRun '''
+    __tablename__ = "quota_allocation"
+    run_id: Mapped[int] = mapped_column(
+        ForeignKey("quota_run.id"), primary_key=True)
+    country_id: Mapped[str] = mapped_column(
+        ForeignKey("country.id"), primary_key=True)
+    # place in the country ranking
+    position: Mapped[int]
+    cap: Mapped[int]
+    quota: Mapped[int]
+    # seats from the Part B redistribution, before the caps
+    part_b: Mapped[int]
+    part_b1: Mapped[float]
+    part_b2: Mapped[float]
+    part_b3: Mapped[float]
+
+    run: Mapped[QuotaRun] = relationship(back_populates="allocations")
+    country: Mapped[Country] = relationship()
@@ -1,12 +1,14 @@
 # -*- coding: utf-8 -*-
+import logging
 from datetime import datetime, timezone
 
 from bs4 import BeautifulSoup as bs4
-import requests
 
-from models import Player, Ruleset, Settings
+from models import Player, RankExplanation, Ruleset, Settings
 from config import HTMLPATH
 from utils.ema_jinja import jinja
+from utils.fetch import Fetcher
+from utils.loaders import load_players, QueryCounter
 
 # TODO these will all go into a css file at some point,
 #      but for now, they're easy to edit here
@@ -27,7 +29,7 @@ footer.site-footer {
 #tablepress-4 {
     margin-top: 1em;
 }
-#tablepress-4 .column-2, #tablepress-4 .column-8 {
+#tablepress-4 .column-2, #tablepress-4 .column-10 {
   border-left: 3px double green !important;
 }
 #tablepress-4 th, #tablepress-4 td {
@@ -57,14 +59,15 @@ class Render_Player:
     '''
     def __init__(self, db):
         self.db = db
-        r = requests.get("https://silk.mahjong.ie/template-player")
-        self.template = r.content
+        self.template = Fetcher.get_once(
+            "https://silk.mahjong.ie/template-player")
         self.totals = {
             'mcr': self.db.query(Settings.value).filter_by(
                 key='player_count_mcr').first()[0],
             'riichi': self.db.query(Settings.value).filter_by(
                 key='player_count_riichi').first()[0]
             }
+        self.explanations = None
 
     def fill_player_summary_table(self, dom):
         '''
@@ -73,7 +76,8 @@ class Render_Player:
         '''
         zone = dom.find(id="tablepress-4").find("tbody")
         j = jinja.from_string(str(zone))
-        new_row = j.render(c=self.counts, p=self.p, t=self.totals)
+        new_row = j.render(c=self.counts, p=self.p, t=self.totals,
+                           why=self.why)
         zone.replace_with(bs4(new_row, 'html.parser'))
 
     def fill_player_tournament_table(self, dom, rules, results):
@@ -97,10 +101,19 @@ class Render_Player:
         count_2nd = 0
         count_3rd = 0
 
+        # which results counted towards this ruleset's rank, and in which
+        # parts of the calculation
+        explanation = self.why.get(rules)
+        parts = {}
+        if explanation is not None:
+            for i, result in enumerate(explanation.results):
+                parts[result[0]] = "A+B" if i < explanation.part_b_count \
+                    else "A"
+
         results_to_hide = 0
         for r in results:
             j = jinja.from_string(str(row))
-            new_row = j.render(t=r)
+            new_row = j.render(t=r, counted=parts.get(r.tournament_id))
             tbody.append(bs4(new_row, 'html.parser'))
             if r.tournament.age_factor == 0:
                 results_to_hide += 1
@@ -130,10 +143,38 @@ class Render_Player:
         # remove the template row, we've finished with it now
         row.decompose()
 
-    def one_player(self, id):
+    def players(self, query=None):
+        """ render every player, or those in query, with all their results
+        loaded up front rather than one lazy load at a time """
+        with QueryCounter(self.db) as counter:
+            players = load_players(self.db, query)
+            self.explanations = {}
+            for e in self.db.query(RankExplanation):
+                self.explanations.setdefault(e.player_id, {})[
+                    e.ruleset.value] = e
+            for p in players:
+                self.one_player(p.ema_id, p)
+            self.explanations = None
+        logging.info(f"rendered {len(players)} players in {counter.count} "
+                     "queries")
+
+    def one_player(self, id, p=None):
         print('.', end='')
         self.counts = {'mcr': [0,0,0,0,0], 'riichi': [0,0,0,0,0]}
-        self.p = self.db.query(Player).filter(Player.ema_id == id).first()
+        if p is None:
+            players = load_players(self.db, self.db.query(Player).filter(
+                Player.ema_id == id).limit(1))
+            if not players:
+                logging.error(f"can't render player {id}, not in the db")
+                return
+            p = players[0]
+        self.p = p
+        # the breakdown of how this player's ranks were calculated
+        if self.explanations is None:
+            self.why = {e.ruleset.value: e for e in self.db.query(
+                RankExplanation).filter_by(player_id=p.id)}
+        else:
+            self.why = self.explanations.get(p.id, {})
         dom = bs4(self.template, "html.parser")
         dom.select_one("style").append(PAGE_STYLES)
         # allocate tournaments to rulesets, most recent first
@@ -148,7 +189,7 @@ class Render_Player:
         player_zone = dom.find(id="player_data")
 
         t = jinja.from_string(str(player_zone))
-        new_text = t.render(p=self.p)
+        new_text = t.render(p=self.p, why=self.why)
         player_zone.replace_with(bs4(new_text, "html.parser"))
 
         self.fill_player_tournament_table(dom, 'mcr', mcr)
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Quota pages, rendered from the runs saved in quota_run, so showing a quota
+never means recalculating it. The template page is described in README.md,
+and its table is jinja-templates/6-Quota-table.csv
+"""
+from datetime import datetime, timezone
+
+from bs4 import BeautifulSoup as bs4
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
+
+from config import HTMLPATH
+from utils.ema_jinja import jinja
+from utils.fetch import Fetcher
+from models import QuotaAllocation, QuotaRun, Ruleset
+
+PAGE_STYLES = '''
+#tablepress-quota td {
+  text-align: center !important;
+}
+.dataTables_filter input[type="search"] {color: #060;}
+'''
+
+
+class Render_Quota:
+
+    def __init__(self, db):
+        self.db = db
+        self.template = Fetcher.get_once(
+            "https://silk.mahjong.ie/template-quota")
+
+    def one_run(self, run: QuotaRun, filename: str = None) -> None:
+        dom = bs4(self.template, "html.parser")
+        dom.select_one("style").append(PAGE_STYLES)
+        print('.', end='')
+
+        main = dom.find(id="main")
+        j = jinja.from_string(str(main))
+        main.replace_with(bs4(j.render(run=run), 'html.parser'))
+        j = jinja.from_string(dom.title.string)
+        dom.title.string.replace_with(bs4(j.render(run=run), 'html.parser'))
+
+        tbody = dom.find(id="tablepress-quota").find("tbody")
+        row = tbody.find("tr")
+        for a in run.allocations:
+            j = jinja.from_string(str(row))
+            tbody.append(bs4(j.render(a=a, run=run), 'html.parser'))
+
+        # remove the template row, we've finished with it now
+        row.decompose()
+
+        dom.find(id='colophon').replace_with(bs4(
+            f'''<footer class="site-footer" role="contentinfo">Quotas
+            calculated: {run.calculated.strftime('%Y-%m-%d %H:%M:%S')}.
+            Page last cached:
+            {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S %z')}
+            </footer>''',
+            features="html.parser"))
+
+        if filename is None:
+            filename = f"quotas_{run.id}.html"
+        with open(HTMLPATH / filename, "w", encoding='utf-8') as file:
+            file.write(str(dom))
+
+    def latest(self, event: str = None) -> None:
+        """ render the latest run for each ruleset, for the event if given,
+        as the quotas_MCR and quotas_RCR pages """
+        for rules in Ruleset:
+            query = select(QuotaRun).where(QuotaRun.ruleset == rules).options(
+                selectinload(QuotaRun.allocations).joinedload(
+                    QuotaAllocation.country)).order_by(
+                QuotaRun.calculated.desc()).limit(1)
+            if event is not None:
+                query = query.where(QuotaRun.event == event)
+            run = self.db.scalars(query).first()
+            if run is None:
+                continue
+            suffix = "MCR" if rules == Ruleset.mcr else "RCR"
+            self.one_run(run, f"quotas_{suffix}.html")
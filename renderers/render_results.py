@@ -1,11 +1,12 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime, timezone
 from bs4 import BeautifulSoup as bs4
-import requests
 
-from models import PlayerTournament, Ruleset
+from models import Ruleset
 from config import HTMLPATH
 from utils.ema_jinja import jinja
+from utils.fetch import Fetcher
+from utils.loaders import load_results
 
 # TODO these will all go into a css file at some point,
 #      but for now, they're easy to edit here
@@ -20,8 +21,8 @@ class Render_Results:
 
     def __init__(self, db):
         self.db = db
-        r = requests.get("https://silk.mahjong.ie/template-results")
-        self.template = r.content
+        self.template = Fetcher.get_once(
+            "https://silk.mahjong.ie/template-results")
 
     def fill_results_table(self, zone, tournament, results) -> dict[str, int]:
 
@@ -54,8 +55,7 @@ class Render_Results:
         dom = bs4(self.template, "html.parser")
         dom.select_one("style").append(PAGE_STYLES)
         print('.', end='')
-        pt = self.db.query(PlayerTournament).filter(
-            PlayerTournament.tournament_id == t.id).all()
+        pt = load_results(self.db, t)
 
         zone = dom.find(id="tablepress-3")
         country_count = self.fill_results_table(zone, t, pt)
@@ -4,11 +4,12 @@
 from datetime import datetime, timezone
 
 from bs4 import BeautifulSoup as bs4
-import requests
 from sqlalchemy import extract
 
 from config import HTMLPATH
 from utils.ema_jinja import jinja
+from utils.fetch import Fetcher
+from utils.loaders import load_tournaments
 from models import Ruleset, Tournament
 
 PAGE_STYLES = '''
@@ -45,8 +46,8 @@ class Render_Year:
 
     def __init__(self, db):
         self.db = db
-        r = requests.get("https://silk.mahjong.ie/template-year")
-        self.template = r.content
+        self.template = Fetcher.get_once(
+            "https://silk.mahjong.ie/template-year")
 
     def render(self, year: int) -> None:
         dom = bs4(self.template, "html.parser")
@@ -65,9 +66,10 @@ class Render_Year:
             tbody = zone.find("tbody")
             row = tbody.find("tr")
 
-            tournaments = self.db.query(Tournament).filter(
+            tournaments = load_tournaments(self.db, self.db.query(
+                Tournament).filter(
                 extract("year", Tournament.start_date) ==  year).filter(
-                    Tournament.ruleset == rules).all()
+                    Tournament.ruleset == rules))
 
             if not len(tournaments):
                 zone.decompose()
@@ -7,8 +7,12 @@ from sqlalchemy.orm import Session
 from sqlalchemy.pool import NullPool
 
 from config import DBPATH
-from models import Player, Tournament, PlayerTournament, Country, Ruleset
+from models import Player, Tournament, PlayerTournament, Country, Ruleset, \
+    Settings
 from utils.scrapers import Tournament_Scraper, Country_Scraper
+from utils.fetch import backend
+from utils.scrape_pipeline import ScrapePipeline
+import utils.parse_benchmark as parse_benchmark
 import utils.csv_writer as csv_writer
 from calculators.ranking import PlayerRankingEngine
 from calculators.ranking_austria_riichi import (
@@ -16,27 +20,18 @@ from calculators.ranking_austria_riichi import (
 )
 from calculators.country_ranking import CountryRankingEngine
 from calculators.quota import QuotaMaker
+from calculators.quota_forecast import QuotaForecast
 from calculators.get_results import results_to_db
 from renderers.render_results import Render_Results
 from renderers.render_player import Render_Player
 from renderers.render_year import Render_Year
 
-logging.basicConfig(
-    filename="testpy.log",
-    filemode="w",  # ensure log file always writes fresh, rather than appending to previous log
-    encoding="utf-8",
-    level=logging.INFO,  # suppress debug messages from imported libraries
-)
-
-logging.info(datetime.now())
 engine = create_engine(DBPATH, poolclass=NullPool)
 
 
 def rank_countries(db):
     """calculate country rankings, used as a basis for national quotas"""
-    r = CountryRankingEngine(db)
-    r.rank_countries_for_one_ruleset(Ruleset.riichi, assess=True)
-    r.rank_countries_for_one_ruleset(Ruleset.mcr, assess=True)
+    CountryRankingEngine(db).rank_countries(assess=True)
 
 
 def rank_players(db, reckoning_day=datetime.now()):
@@ -63,7 +58,18 @@ def rank_aut_players(db):
 
 def scrape_tournaments(db):
     """scrape the EMA mirror site and put all the data into our database"""
-    Tournament_Scraper(db).scrape_all()  #  example parameters: start=2023, end=2024
+    with Tournament_Scraper(db) as scraper:
+        ScrapePipeline(scraper).scrape_all()  #  example parameters: start=2023, end=2024
+
+
+def scrape_mirror(db, directory):
+    """rebuild the database from a local mirror of the EMA site, offline"""
+    ScrapePipeline(Tournament_Scraper(db, backend(directory))).scrape_all()
+
+
+def benchmark_parsing(directory):
+    """time parsing the saved pages in a mirror, in full and fast modes"""
+    parse_benchmark.benchmark(directory)
 
 
 def make_quotas(db):
@@ -72,6 +78,55 @@ def make_quotas(db):
     QuotaMaker(db, 140, Ruleset.riichi).make()
 
 
+def live_state(db):
+    """everything that re-ranking writes: player ranks and positions, aged
+    weights, country rankings and settings"""
+    return [
+        db.query(Player.id, Player.mcr_rank, Player.riichi_rank,
+                 Player.mcr_position, Player.riichi_position).order_by(
+                 Player.id).all(),
+        db.query(Tournament.id, Tournament.age_factor).order_by(
+            Tournament.id).all(),
+        db.query(PlayerTournament.player_id, PlayerTournament.tournament_id,
+                 PlayerTournament.aged_mers).order_by(
+                 PlayerTournament.player_id,
+                 PlayerTournament.tournament_id).all(),
+        [tuple(getattr(c, k) for k in sorted(c.__table__.columns.keys()))
+         for c in db.query(Country).order_by(Country.id)],
+        db.query(Settings.key, Settings.value).order_by(Settings.key).all(),
+        ]
+
+
+def quota_at_cutoff(db):
+    """quotas ranked on a past cutoff date, checking that the live ranking
+    and settings are left as they were"""
+    before = live_state(db)
+    QuotaMaker.quota_for(db, "WRC 2025", Ruleset.riichi, 140,
+                         cutoff_date=datetime(2025, 6, 30), refresh=True)
+    if live_state(db) != before:
+        logging.error("quota_for with a cutoff date changed the live ranking")
+    else:
+        logging.info("quota_for with a cutoff date left the live ranking alone")
+
+
+def quota_curves(db):
+    """the riichi quota for every total from 120 to 148 seats, as a matrix"""
+    q = QuotaMaker(db, 0, Ruleset.riichi)
+    curves = q.curves(range(120, 149))
+    with open("quota_curves_riichi.csv", "w", encoding="utf-8") as file:
+        q.write_curves_csv(file, curves)
+
+
+def forecast_quotas(db):
+    """how likely each country is to gain or lose WRC seats by the cutoff,
+    as it looked at the start of the year"""
+    forecast = QuotaForecast(db, Ruleset.riichi, 140, datetime(2025, 6, 30),
+                             start=datetime(2025, 1, 1))
+    forecast.simulate(10000)
+    with open("quota_forecast_riichi.csv", "w", encoding="utf-8") as file:
+        forecast.write_csv(file)
+
+
 def render_one_results(db):
     """In production we will render a page for every tournament. However,
     for now, we just render a few samples to test the process"""
@@ -87,89 +142,93 @@ def render_one_results(db):
 def render_players(db):
     """In production we will render a page for every player. However, for now,
     we just render a few sample players to test the process"""
-    r = Render_Player(db)
     # for id in (
     #     "07000155", # lots in each ruleset
     #     "14990047", # riichi only
     #     "04390002", # mcr only
     #     "07000001", # bad rank calc?
     #     ):
-    all_players = db.query(Player)
-    for p in all_players:
-        r.one_player(p.ema_id)
+    Render_Player(db).players()
+
+
+def country_ranking_history(db):
+    """country rankings at quota cutoff dates, saved in country_rank_history"""
+    days = [datetime(2024, 1, 1), datetime(2024, 7, 1), datetime(2025, 1, 1)]
+    CountryRankingEngine(db).rank_countries_on(days)
 
 
 def ranked_player_counts(db):
-    for m in range(1, 13):
+    days = [datetime(2024, m, 1) for m in range(1, 13)]
+    snapshots = PlayerRankingEngine(db).sweep(days)
+    players = db.query(Player).filter(Player.country_id.isnot(None)).all()
+    names = {c.id: c.name_english for c in db.query(Country)}
+
+    for m, day in enumerate(days, start=1):
         print(f"\nMonth {m}")
-        rank_players(db, reckoning_day=datetime(2024, m, 1))
-
-        # Get all countries that have any ranked players
-        countries = (
-            db.query(Country)
-            .join(Player)
-            .filter((Player.mcr_rank.isnot(None)) | (Player.riichi_rank.isnot(None)))
-            .distinct()
-            .order_by(Country.name_english)
-            .all()
-        )
-
-        # Get all ranked players in one query
-        all_ranked_players = (
-            db.query(Player)
-            .filter((Player.mcr_rank.isnot(None)) | (Player.riichi_rank.isnot(None)))
-            .all()
-        )
+        snapshot = snapshots[day]
+
+        # count ranked players per country
+        counts = {}
+        for p in players:
+            mcr = snapshot.rank(p.id, Ruleset.mcr) is not None
+            riichi = snapshot.rank(p.id, Ruleset.riichi) is not None
+            if mcr or riichi:
+                country = counts.setdefault(p.country_id, [0, 0, 0])
+                country[0] += mcr
+                country[1] += riichi
+                country[2] += mcr and riichi
 
         # Initialize totals for this month
         total_mcr = 0
         total_riichi = 0
         total_both = 0
 
-        for country in countries:
-            # Filter the already-fetched players by country
-            country_players = [
-                p for p in all_ranked_players if p.country_id == country.id
-            ]
-            mcr = sum(1 for p in country_players if p.mcr_rank is not None)
-            riichi = sum(1 for p in country_players if p.riichi_rank is not None)
-            both = sum(
-                1
-                for p in country_players
-                if p.mcr_rank is not None and p.riichi_rank is not None
-            )
+        for cid in sorted(counts, key=lambda c: names[c]):
+            mcr, riichi, both = counts[cid]
 
             # Add to totals
             total_mcr += mcr
             total_riichi += riichi
             total_both += both
 
-            print(f"{country.name_english}, {m}, {mcr}, {riichi}, {both}")
+            print(f"{names[cid]}, {m}, {mcr}, {riichi}, {both}")
 
         # Print totals for this month
         print(f"TOTAL, {m}, {total_mcr}, {total_riichi}, {total_both}")
 
 
-with Session(engine) as db:
-    # Tournament_Scraper(db).scrape_all(start=2024, end=2024)
-    ranked_player_counts(db)
+# the parallel ranking engine starts worker processes, which import this
+# file again on Windows, so only do the work when we're run directly
+if __name__ == "__main__":
+    logging.basicConfig(
+        filename="testpy.log",
+        filemode="w",  # ensure log file always writes fresh, rather than appending to previous log
+        encoding="utf-8",
+        level=logging.INFO,  # suppress debug messages from imported libraries
+    )
 
-    # rank_countries(db)
-    # QuotaMaker(db, 56, Ruleset.riichi).make()
+    logging.info(datetime.now())
 
-    # QuotaMaker(db, 148, Ruleset.mcr).make()
+    with Session(engine) as db:
+        # Tournament_Scraper(db).scrape_all(start=2024, end=2024)
+        ranked_player_counts(db)
+
+        # rank_countries(db)
+        # QuotaMaker(db, 56, Ruleset.riichi).make()
+
+        # QuotaMaker(db, 148, Ruleset.mcr).make()
 
-    # rank_players(db, reckoning_day=datetime(2024,7,1))
-    # rank_countries(db)
+        # rank_players(db, reckoning_day=datetime(2024,7,1))
+        # rank_countries(db)
 
-    # rank_aut_players(db)
-    # make_quotas(db)
-    # Render_Year(db).years(2005, 2024)
-    # render_one_results(db)
-    # render_players(db)
-    # results_to_db(db, 'd:\\zaps\\emarebuild\\fake-tourney.xls', 'rcr220')
-    # PlayerRankingEngine(db).rank_one_player_for_one_ruleset("11990143", Ruleset.riichi)
-    pass
+        # rank_aut_players(db)
+        # make_quotas(db)
+        # Render_Year(db).years(2005, 2024)
+        # render_one_results(db)
+        # render_players(db)
+        # results_to_db(db, 'd:\\zaps\\emarebuild\\fake-tourney.xls', 'rcr220')
+        # PlayerRankingEngine(db).rank_one_player_for_one_ruleset("11990143", Ruleset.riichi)
+        pass
 
-print("done")
-sys.exit(0)
+    print("done")
+    sys.exit(0)
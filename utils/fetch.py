@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+'''
+Fetching web pages for the scrapers.
+
+The scrapers only need get(path), so where the pages come from is
+pluggable: Fetcher gets them over HTTP, and MirrorFetcher reads them from a
+local mirror of the site, such as the one made by httrack. backend() picks
+one from a url or a directory.
+
+One requests.Session is shared, so connections are kept alive and pooled.
+Failed requests and server errors are retried with exponential backoff.
+Pages can be prefetched on a bounded pool of threads, with at most
+per_host requests to any one host at a time, and a politeness delay between
+the start of one request to a host and the next. Everything that parses a
+page still just calls get(), and gets the prefetched page if there is one,
+so a full scrape is limited by bandwidth rather than by round trips.
+
+Pages are fetched relative to base, which defaults to the EMA mirror, and
+can be pointed at a local stand-in, e.g.
+    python -m http.server -d mirror 8000
+    Fetcher("http://localhost:8000/ranking/")
+
+With an HttpCache, pages are revalidated with a conditional request rather
+than downloaded again. Whether a page has changed is up to the scrapers, which
+compare its hash with the one stored for it.
+'''
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import logging
+from pathlib import Path
+import threading
+import time
+from urllib.parse import unquote, urljoin, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from config import CACHEPATH
+from utils.http_cache import HttpCache
+
+URLBASE = "https://silk.mahjong.ie/ranking/"
+#URLBASE = "http://mahjong-europe.org/ranking/"
+
+
+class Page:
+    """ the parts of a response that the scrapers use. hash is the SHA-256
+    of its content, if it was cached """
+    __slots__ = ("url", "status", "content", "hash")
+
+    def __init__(self, url: str, status: int, content: bytes = b"",
+                 hash: str = None):
+        self.url = url
+        self.status = status
+        self.content = content
+        self.hash = hash
+
+    @property
+    def ok(self) -> bool:
+        return 200 <= self.status < 400
+
+    def __repr__(self):
+        return f"Page({self.url!r}, {self.status})"
+
+
+class FetchBackend:
+    """ where the scrapers get their pages from. Paths are relative to base
+    """
+    def __init__(self, base: str = URLBASE):
+        self.base = base
+
+    def url(self, path: str) -> str:
+        """ the full url for a path relative to base """
+        return urljoin(self.base, path)
+
+    def get(self, path: str) -> Page:
+        raise NotImplementedError
+
+    def prefetch(self, paths) -> None:
+        """ a hint that these pages will be wanted soon """
+
+    def map(self, paths):
+        """ fetch all the paths, and yield each page in order """
+        paths = list(paths)
+        self.prefetch(paths)
+        for path in paths:
+            yield self.get(path)
+
+    def close(self):
+        pass
+
+
+class Fetcher(FetchBackend):
+    """ get pages over HTTP """
+    def __init__(self, base: str = URLBASE, workers: int = 8,
+                 per_host: int = 4, delay: float = 0.1, retries: int = 3,
+                 backoff: float = 0.5, timeout: float = 30,
+                 cache: HttpCache = None):
+        super().__init__(base)
+        self.cache = cache
+        self.delay = delay
+        self.timeout = timeout
+        self.per_host = per_host
+        self.session = requests.Session()
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=("GET",),
+            raise_on_status=False,
+            )
+        # the per-host limit is the semaphore in _host, so the connection
+        # pool only needs to keep a connection for each worker
+        adapter = HTTPAdapter(pool_maxsize=workers, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.pool = ThreadPoolExecutor(workers)
+        self.prefetched = {}
+        self.lock = threading.Lock()
+        # per host: a semaphore for the concurrency limit, and the earliest
+        # time that the next request may start
+        self.hosts = {}
+
+    def _host(self, url: str):
+        host = urlsplit(url).netloc
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = [threading.BoundedSemaphore(self.per_host),
+                                    0.0]
+            return self.hosts[host]
+
+    def _wait_turn(self, host):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, host[1])
+            host[1] = start + self.delay
+        if start > now:
+            time.sleep(start - now)
+
+    def fetch(self, url: str) -> Page:
+        """ fetch the url now, ignoring anything prefetched """
+        entry = None if self.cache is None else self.cache.lookup(url)
+        headers = {} if entry is None else self.cache.headers(entry)
+        host = self._host(url)
+        with host[0]:
+            self._wait_turn(host)
+            try:
+                r = self.session.get(url, timeout=self.timeout,
+                                     headers=headers)
+            except requests.RequestException as e:
+                if entry is not None:
+                    logging.warning(f"failed to fetch {url}, using the "
+                                    f"cached copy: {e}")
+                    return Page(url, 200, self.cache.body(entry),
+                                entry["hash"])
+                logging.error(f"failed to fetch {url}: {e}")
+                return Page(url, 0)
+        if r.status_code == 304 and entry is not None:
+            return Page(url, 200, self.cache.body(entry),
+                        entry["hash"])
+        page = Page(url, r.status_code, r.content)
+        if self.cache is not None and r.status_code == 200:
+            page.hash = self.cache.store(
+                url, r.content, r.headers.get("ETag"),
+                r.headers.get("Last-Modified"))
+        return page
+
+    def prefetch(self, paths) -> None:
+        """ start fetching pages in the background, for get() to pick up """
+        for path in paths:
+            url = self.url(path)
+            with self.lock:
+                if url not in self.prefetched:
+                    self.prefetched[url] = self.pool.submit(self.fetch, url)
+
+    def get(self, path: str) -> Page:
+        """ the page at path, relative to base. If it's been prefetched,
+        wait for that rather than fetching it again """
+        url = self.url(path)
+        with self.lock:
+            future = self.prefetched.pop(url, None)
+        if future is not None:
+            return future.result()
+        return self.fetch(url)
+
+    @classmethod
+    def cached(cls, base: str = URLBASE, **kwargs):
+        """ a Fetcher with the on-disk cache in config.CACHEPATH """
+        return cls(base, cache=HttpCache(CACHEPATH), **kwargs)
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+        self.session.close()
+
+    @classmethod
+    def get_once(cls, url: str) -> bytes:
+        """ the content of one page, e.g. a renderer's template, from a
+        cached Fetcher that is closed again straight away """
+        fetcher = cls.cached()
+        try:
+            return fetcher.get(url).content
+        finally:
+            fetcher.close()
+
+
+class MirrorFetcher(FetchBackend):
+    """ read pages from a local mirror of the site. Every url is looked for
+    under root/<host>/<path>, which is how httrack lays out a mirror, so
+    root is the directory that holds the host's folder, e.g. the pages under
+    https://silk.mahjong.ie/ranking/ are in root/silk.mahjong.ie/ranking/.
+    A mirror of another host needs the base to match it """
+    def __init__(self, root, base: str = URLBASE):
+        super().__init__(base)
+        self.root = Path(root)
+
+    def file(self, url: str) -> Path:
+        parts = urlsplit(url)
+        return self.root / parts.netloc / unquote(parts.path.lstrip("/"))
+
+    def get(self, path: str) -> Page:
+        url = self.url(path)
+        try:
+            content = self.file(url).read_bytes()
+        except OSError:
+            return Page(url, 404)
+        return Page(url, 200, content,
+                    hash=hashlib.sha256(content).hexdigest())
+
+
+def backend(source: str = URLBASE) -> FetchBackend:
+    """ a cached Fetcher if source is a url, or a MirrorFetcher if it's
+    the directory of a mirror of the site """
+    if source.startswith(("http://", "https://")):
+        return Fetcher.cached(source)
+    return MirrorFetcher(source)
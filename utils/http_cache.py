@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+'''
+On-disk cache of fetched web pages, so that a re-scrape only downloads the
+pages that have changed.
+
+Page bodies are stored by the SHA-256 of their content, under objects/, so
+identical pages are only stored once. Each url has a small JSON entry,
+under urls/, with its ETag, Last-Modified and content hash. Fetcher sends
+these back as If-None-Match and If-Modified-Since, and a 304 reply means
+the cached body can be used as it is.
+'''
+import hashlib
+import json
+import os
+from pathlib import Path
+import tempfile
+
+
+def _hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class HttpCache:
+    def __init__(self, path):
+        self.path = Path(path)
+        (self.path / "urls").mkdir(parents=True, exist_ok=True)
+        (self.path / "objects").mkdir(parents=True, exist_ok=True)
+
+    def _write(self, path: Path, data: bytes):
+        """ write atomically, as other threads may be reading """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        fd, temp = tempfile.mkstemp(dir=path.parent)
+        with os.fdopen(fd, "wb") as file:
+            file.write(data)
+        os.replace(temp, path)
+
+    def _entry_path(self, url: str) -> Path:
+        return self.path / "urls" / f"{_hash(url.encode())}.json"
+
+    def _object_path(self, content_hash: str) -> Path:
+        return self.path / "objects" / content_hash[:2] / content_hash
+
+    def lookup(self, url: str):
+        """ the cached entry for url, or None. The entry is a dict with
+        url, etag, last_modified and hash """
+        try:
+            with open(self._entry_path(url), encoding="utf-8") as file:
+                entry = json.load(file)
+        except (OSError, ValueError):
+            return None
+        if not self._object_path(entry["hash"]).exists():
+            return None
+        return entry
+
+    def headers(self, entry) -> dict:
+        """ the headers for a conditional request """
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def body(self, entry) -> bytes:
+        with open(self._object_path(entry["hash"]), "rb") as file:
+            return file.read()
+
+    def store(self, url: str, content: bytes, etag: str = None,
+              last_modified: str = None) -> str:
+        """ save a page, and return its content hash """
+        content_hash = _hash(content)
+        body = self._object_path(content_hash)
+        if not body.exists():
+            self._write(body, content)
+        self._write(self._entry_path(url), json.dumps({
+            "url": url,
+            "etag": etag,
+            "last_modified": last_modified,
+            "hash": content_hash,
+            }).encode("utf-8"))
+        return content_hash
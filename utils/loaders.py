@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+'''
+Batched loading of players, results and tournaments.
+
+Walking p.tournaments, then r.tournament, then t.country, lazy-loads each
+one with its own SELECT, so handling N players costs several times N
+queries. These loaders fetch everything that the calculators and renderers
+need up front, in a handful of queries, however many players there are.
+
+QueryCounter counts the SQL statements run, so we can check.
+'''
+import logging
+
+from sqlalchemy import event
+from sqlalchemy.orm import joinedload, selectinload
+
+from models import Player, PlayerTournament, Tournament
+
+
+class QueryCounter:
+    """ count the SQL statements that a session runs, e.g.
+        with QueryCounter(db) as counter:
+            ...
+        logging.info(f"{counter.count} queries")
+    """
+    def __init__(self, db):
+        self.engine = db.get_bind()
+        self.count = 0
+
+    def _count(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self._count)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(self.engine, "before_cursor_execute", self._count)
+
+
+def load_players(db, query=None, tournaments=True):
+    """ players, with their results and their country. If tournaments is
+    set, each result's tournament and the tournament's country are loaded
+    too. query can narrow down which players to load """
+    if query is None:
+        query = db.query(Player)
+    results = selectinload(Player.tournaments)
+    if tournaments:
+        results = results.joinedload(PlayerTournament.tournament).joinedload(
+            Tournament.country)
+    with QueryCounter(db) as counter:
+        players = query.options(
+            results,
+            joinedload(Player.country),
+            ).all()
+    logging.debug(f"loaded {len(players)} players in {counter.count} queries")
+    return players
+
+
+def load_results(db, tournament: Tournament):
+    """ all the results for a tournament, with their players """
+    return db.query(PlayerTournament).filter(
+        PlayerTournament.tournament_id == tournament.id).options(
+        joinedload(PlayerTournament.player)).all()
+
+
+def load_tournaments(db, query=None):
+    """ tournaments, with their country """
+    if query is None:
+        query = db.query(Tournament)
+    return query.options(joinedload(Tournament.country)).all()
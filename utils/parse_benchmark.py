@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+'''
+Times the parsing of saved tournament and player pages, such as those in a
+mirror of the site, in full and in the fast mode that only builds the parts
+of each page that are read. It checks that both modes extract exactly the
+same fields, and logs any page where they don't.
+'''
+import logging
+import time
+
+from utils.fetch import MirrorFetcher, URLBASE
+from utils.scrapers import parse_player_page, parse_tournament_page, \
+                           player_parts, tournament_parts
+
+KINDS = (
+    ("tournament", "Tournament/TR_*.html", parse_tournament_page,
+     tournament_parts),
+    ("player", "Players/*.html", parse_player_page, player_parts),
+    )
+
+
+def _time(parse, content, fast: bool):
+    start = time.perf_counter()
+    try:
+        fields = parse(content, fast=fast)
+    except Exception as e:
+        fields = repr(e)
+    return time.perf_counter() - start, fields
+
+
+def benchmark(root, limit: int = None, base: str = URLBASE) -> dict:
+    """ parse up to limit pages of each kind in the mirror at root, laid out
+    as MirrorFetcher expects, both ways, and print the time per page.
+    Returns {kind: (pages, full seconds, fast seconds, malformed,
+    mismatches)} """
+    mirror = MirrorFetcher(root, base)
+    directory = mirror.file(mirror.url(""))
+    totals = {}
+    for kind, pattern, parse, parts in KINDS:
+        files = sorted(directory.glob(pattern))[:limit]
+        if not files:
+            logging.warning(f"no {kind} pages in {directory / pattern}")
+        full = fast = 0.0
+        malformed = mismatches = 0
+        for file in files:
+            content = file.read_bytes()
+            malformed += not parts.well_formed(content)
+            seconds, expected = _time(parse, content, False)
+            full += seconds
+            seconds, fields = _time(parse, content, True)
+            fast += seconds
+            if fields != expected:
+                mismatches += 1
+                logging.error(f"fast parse of {file} differs: {fields} "
+                              f"instead of {expected}")
+        totals[kind] = (len(files), full, fast, malformed, mismatches)
+        if files:
+            print(f"{kind}: {len(files)} pages, "
+                  f"full {1000 * full / len(files):.2f} ms/page, "
+                  f"fast {1000 * fast / len(files):.2f} ms/page "
+                  f"({full / fast:.1f}x), {malformed} parsed in full as "
+                  f"malformed, {mismatches} mismatches")
+    return totals
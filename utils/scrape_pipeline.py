@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+'''
+The tournament scrape as a pipeline of three stages, so that fetching,
+parsing and writing all overlap:
+
+    fetch --pages--> parse, in a pool of processes --parsed--> write
+
+The fetch thread reads each year's list of tournaments, and gets the
+tournament pages, with the fetcher working a window of pages ahead. The
+parse thread hands each page to the process pool, which turns it into a
+plain dict with parse_tournament_page. The writer, on the calling thread,
+is the only stage that touches the database, and stores the tournaments in
+order, just as Tournament_Scraper.scrape_all does.
+
+The queues between the stages are bounded, so a stage that gets ahead waits
+for the next one to catch up, and memory stays flat over a full scrape.
+
+Which players are new is only known once the writer has a tournament, so
+their pages are fetched then, and parsed in the same pool while the writer
+stores what it can.
+'''
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import os
+import queue
+import threading
+
+from sqlalchemy import select
+
+from models import Tournament
+from utils.scrapers import parse_player_page, parse_tournament_page, \
+                           parse_year_page, Tournament_Scraper
+
+# marks the end of a queue
+_DONE = object()
+
+
+class ScrapePipeline:
+    def __init__(self, scraper: Tournament_Scraper, processes: int = None,
+                 depth: int = 32):
+        self.scraper = scraper
+        self.session = scraper.session
+        self.fetcher = scraper.fetcher
+        self.processes = processes or os.cpu_count() or 1
+        self.depth = depth
+        self.stop = threading.Event()
+
+    def _put(self, q: queue.Queue, item) -> bool:
+        """ put item on a bounded queue, waiting for room, unless the
+        pipeline has been stopped """
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _get(self, q: queue.Queue):
+        """ the next item on a queue, or _DONE if the pipeline has been
+        stopped """
+        while not self.stop.is_set():
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        return _DONE
+
+    def _fetch(self, years, known: dict, incremental: bool, pages):
+        """ stage 1: put (year, id, ruleset, countries, page hash, page) on
+        pages, with page None for an unchanged page in incremental mode """
+        try:
+            self.fetcher.prefetch(f"Tournament/Tournaments_{year}.html"
+                                  for year in years)
+            for year in years:
+                listed = parse_year_page(self.fetcher.get(
+                    f"Tournament/Tournaments_{year}.html").content)
+                paths = [self.scraper.tournament_path(tid, rules)
+                         for tid, rules, _ in listed]
+                for i, (tid, rules, countries) in enumerate(listed):
+                    # keep a window of pages on their way
+                    self.fetcher.prefetch(paths[i:i + self.depth])
+                    page = self.scraper.get_tournament_page(tid, rules)
+                    page_hash = self.scraper.page_hash(page)
+                    if incremental and known.get((tid, rules)) == page_hash:
+                        page = None
+                    if not self._put(pages, (year, tid, rules, countries,
+                                             page_hash, page)):
+                        return
+        except Exception as e:
+            self._put(pages, e)
+        self._put(pages, _DONE)
+
+    def _parse(self, pool, pages, parsed):
+        """ stage 2: pass each page to the pool, and put the future of its
+        dict on parsed. Any error, here or passed on from the fetch stage,
+        goes on parsed for the writer to raise, and parsed always ends with
+        _DONE, so the writer never waits for a stage that has died """
+        try:
+            while True:
+                item = self._get(pages)
+                if item is _DONE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                *job, page = item
+                future = None if page is None else \
+                    pool.submit(parse_tournament_page, page.content)
+                if not self._put(parsed, (*job, future)):
+                    return
+        except Exception as e:
+            self._put(parsed, e)
+        finally:
+            self._put(parsed, _DONE)
+
+    def scrape_all(self, start: int = 2005, end: int = 2025,
+                   incremental: bool = False):
+        """ scrape every year, as Tournament_Scraper.scrape_all does """
+        known = {} if not incremental else {
+            (old_id, rules): page_hash for old_id, rules, page_hash in
+            self.session.execute(select(
+                Tournament.old_id, Tournament.ruleset, Tournament.page_hash))}
+        pages = queue.Queue(self.depth)
+        parsed = queue.Queue(self.depth)
+        with ProcessPoolExecutor(self.processes) as pool:
+            threads = [
+                threading.Thread(target=self._fetch, daemon=True, args=(
+                    list(range(start, end)), known, incremental, pages)),
+                threading.Thread(target=self._parse, daemon=True, args=(
+                    pool, pages, parsed)),
+                ]
+            for thread in threads:
+                thread.start()
+            try:
+                self._write(pool, parsed)
+            finally:
+                self.stop.set()
+                for thread in threads:
+                    thread.join()
+
+    def _write(self, pool, parsed):
+        """ stage 3: store each tournament, in order """
+        year = None
+        while True:
+            item = self._get(parsed)
+            if item is _DONE:
+                return
+            if isinstance(item, Exception):
+                raise item
+            this_year, tid, rules, countries, page_hash, future = item
+            if this_year != year:
+                year = this_year
+                print(f"\n getting tournaments for {year}")
+            print('.', end='')
+            if future is None:
+                continue
+            info = future.result()
+            t = self.session.query(Tournament).filter_by(
+                old_id=tid, ruleset=rules).first()
+            # get and parse the new players' pages while the tournament is
+            # stored, for store_results to pick up as it needs them
+            new = self.scraper.new_players(info["results"])
+            paths = [f"Players/{ema_id}.html" for ema_id in new]
+            self.fetcher.prefetch(paths)
+            players = {ema_id: pool.submit(parse_player_page,
+                                           self.fetcher.get(path).content)
+                       for ema_id, path in zip(new, paths)}
+            self.scraper.store_tournament(t, tid, rules, countries, info,
+                                          page_hash, players)
+            logging.debug(f"stored {rules} {tid}, with {len(new)} new "
+                          "players")
@@ -2,9 +2,9 @@
 
 # Based on data_scrapers.py from Jesterboxboy
 
+import hashlib
 import logging
-import requests
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 import re
 from datetime import datetime
 from dateutil.parser import parse as du_parse
@@ -16,24 +16,212 @@ import pycountry
 from models import Player, Tournament, PlayerTournament, Country, Club, \
                    Ruleset
 from calculators.ranking import PlayerRankingEngine
+from utils.fetch import FetchBackend, Fetcher
 
 country_link_pattern = re.compile(r'Country/([A-Z]{3})_')
 country_pattern = re.compile(r'/([a-z]{2}).png')
-URLBASE = "https://silk.mahjong.ie/ranking/"
-#URLBASE = "http://mahjong-europe.org/ranking/"
 
 def french_float(number_string):
     return float(number_string.replace(',', '.'))
 
+# Parsing a page into a plain dict is kept apart from storing it, so pages
+# can be parsed in other processes, see scrape_pipeline.py. The dicts hold
+# the raw text of the cells, and the scraper does the conversions as it
+# stores them.
+
+# Only the parts of a tournament or player page that are read are built into
+# a tree, which is much quicker than building the whole page with all its
+# menus. A tag that's left out can't close one that's kept, so a page with
+# unclosed tags is parsed in full instead, as it always used to be. This
+# needs beautifulsoup4 4.13 or later, as older versions never ask a strainer
+# about allow_tag_creation, and so build the whole page anyway.
+
+class PageParts(SoupStrainer):
+    """build only the named tags, and everything inside them. parts maps
+    each tag name to the classes it needs one of, or to None for any tag of
+    that name. The page counts as well formed if the start and end tags of
+    each name in balanced match up"""
+    def __init__(self, parts: dict, balanced: tuple):
+        super().__init__()
+        self.parts = parts
+        self.balanced = [(re.compile(rb"<%s[\s>]" % name.encode(), re.I),
+                          re.compile(rb"</%s\s*>" % name.encode(), re.I))
+                         for name in balanced]
+
+    def allow_tag_creation(self, nsprefix, name, attrs):
+        if name not in self.parts:
+            return False
+        classes = self.parts[name]
+        if classes is None:
+            return True
+        value = (attrs or {}).get("class") or ""
+        if isinstance(value, str):
+            value = value.split()
+        return not classes.isdisjoint(value)
+
+    def well_formed(self, content) -> bool:
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        return all(len(start.findall(content)) == len(end.findall(content))
+                   for start, end in self.balanced)
+
+tournament_parts = PageParts({"td": None, "div": {"TCTT_lignes"}},
+                             ("td", "div"))
+player_parts = PageParts({"div": {"contentpaneopen"}}, ("div",))
+
+def page_soup(content, parts: PageParts = None):
+    """the tree of a page, or of just its parts, if they're given and the
+    page is well formed"""
+    if parts is not None and parts.well_formed(content):
+        return BeautifulSoup(content, "html.parser", parse_only=parts)
+    return BeautifulSoup(content, "html.parser")
+
+def parse_year_page(content: bytes) -> list:
+    """the (old_id, ruleset, country count) of every tournament listed on a
+    year page"""
+    year_soup = BeautifulSoup(content, "html.parser")
+    listed = []
+    table_raw = year_soup.findAll(
+        "div", {"class": "Tableau_CertifiedTournament"})
+    if table_raw is not None and len(table_raw) > 0:
+        # iterate over each ruleset
+        # we need to specify whether it's mcr or RCR,
+        # as ids are duplicated between them!!!
+        ruleset = Ruleset.mcr
+        for table in table_raw:
+            tournaments = table.findAll(
+                "div", {"class": re.compile('TCTT_ligne*')})[2:]
+            for tourney in tournaments:
+                cells = tourney.find_all("p")
+                listed.append((int(cells[0].string), ruleset,
+                               cells[6].string))
+            ruleset = Ruleset.riichi
+    return listed
+
+def parse_tournament_page(content: bytes, fast: bool = True) -> dict:
+    """the tournament details, and a dict for each row of results. If fast
+    is set, only the parts that are read are parsed, unless that fails"""
+    if fast:
+        try:
+            return tournament_from_soup(page_soup(content, tournament_parts))
+        except (IndexError, KeyError, AttributeError, TypeError,
+                ValueError) as e:
+            logging.warning("fast parse failed, parsing the whole page: "
+                            f"{e!r}")
+    return tournament_from_soup(page_soup(content))
+
+def tournament_from_soup(tournament_soup) -> dict:
+    tournament_info = tournament_soup.findAll("td")
+    info = {}
+
+    # get mers weight
+    try:
+        weight_string = tournament_info[12].string.strip().split("(")[0]
+        info["weight"] = french_float(weight_string)
+    except:
+        info["weight"] = 0
+
+    info["place"] = tournament_info[6].text.lstrip().split("(")[0].title()
+    country_string = tournament_info[6].findAll("a")[0]["href"]
+    country_match = country_link_pattern.search(country_string)
+    info["old3"] = "???" if country_match is None else \
+        country_match.group(1)
+    try:
+        flag_string = tournament_info[6].find("img").attrs['src']
+        matches = country_pattern.search(flag_string)
+        info["iso2"] = matches[1]
+    except:
+        info["iso2"] = "??"
+    info["raw_date"] = tournament_info[8].text.strip().title()
+    info["title"] = tournament_info[4].text.strip().title()
+    info["player_count"] = tournament_info[10].text
+
+    results_table = tournament_soup.findAll(
+        "div", {"class": "TCTT_lignes"})[0]
+    info["results"] = [parse_result_row(result) for result in
+        results_table.findAll("div", {"class": re.compile('TCTT_ligne*')})[1:]]
+    return info
+
+def _string(tag):
+    """tag.string as a plain str, as a NavigableString drags the whole tree
+    along with it when it's pickled"""
+    return None if tag.string is None else str(tag.string)
+
+def parse_result_row(result) -> dict:
+    result_content = result.findAll("p")
+    return {
+        "position": result_content[0].text,
+        "ema_id": result_content[1].text,
+        "last_name": _string(result_content[2]),
+        "first_name": _string(result_content[3]),
+        "table_points": result_content[5].text,
+        "score": result_content[6].text,
+        "official_rank": result_content[7].text,
+        }
+
+def parse_player_page(content: bytes, fast: bool = True) -> dict:
+    """the player's names, picture, country, clubs and official ranks. If
+    the page can't be read, the fields are left as far as it got. If fast is
+    set, only the part that's read is parsed"""
+    info = {
+        "calling_name": None,
+        "sorting_name": None,
+        "pic": None,
+        "iso2": "??",
+        "old3": "???",
+        "national_org": None,
+        "club": None,
+        "ranked": False,
+        }
+    tables = rows = None
+    try:
+        dom = page_soup(content, player_parts if fast else None)
+        tables = dom.findAll(
+            "div", {"class": "contentpaneopen"})[0].findAll("table")
+        rows = tables[0].find_all("tr")
+        info["calling_name"] = rows[2].find_all("td")[1].string.title()
+        names = info["calling_name"].split(" ")
+        info["sorting_name"] = names[-1] + ", " + "  ".join(names[0:-1])
+        info["pic"] = rows[0].find("img").attrs["src"]
+        flag_string = rows[3].find("img").attrs["src"]
+        matches = country_pattern.search(flag_string)
+        iso2 = matches[1]
+        country_string = rows[3].find("a").attrs["href"]
+        country_match = country_link_pattern.search(country_string)
+        info["old3"] = "???" if country_match is None else \
+            country_match.group(1)
+        info["iso2"] = iso2
+    except:
+        pass
+    for key, row in (("national_org", 4), ("club", 5)):
+        try:
+            org = rows[row].findAll("td")[1]
+            info[key] = (_string(org), org.find("a").attrs["href"])
+        except:
+            pass
+
+    if tables is not None:
+        # the official rankings for both rulesets
+        info["ranked"] = True
+        rows = tables[1].find_all("tr")
+        for key, row in (("mcr_official_rank", 2),
+                         ("riichi_official_rank", 3)):
+            try:
+                info[key] = french_float(rows[row].find_all("td")[2].text)
+            except:
+                info[key] = None
+    return info
+
 class Country_Scraper:
     def __init__(self, session):
         self.db = session
 
     @staticmethod
-    def scrape_country_rankings(url: str):
+    def scrape_country_rankings(url: str, fetcher: FetchBackend = None):
         ranking = []
-        best_nation_page = requests.get(url)
-        year_soup = BeautifulSoup(best_nation_page.content, "html.parser")
+        content = Fetcher.get_once(url) if fetcher is None else \
+            fetcher.get(url).content
+        year_soup = BeautifulSoup(content, "html.parser")
         rows = year_soup.find(
             "div", {"class": "PodiumTB"}).find_all(
             "div", {"class": "TCTT_ligne"})
@@ -50,8 +238,23 @@ class Country_Scraper:
         return ranking
 
 class Tournament_Scraper:
-    def __init__(self, session):
+    def __init__(self, session, fetcher: FetchBackend = None):
         self.session = session
+        # pages are fetched relative to fetcher.base, over HTTP or from a
+        # local mirror. A fetcher made here is closed by close()
+        self.own_fetcher = fetcher is None
+        self.fetcher = fetcher or Fetcher.cached()
+
+    def close(self):
+        """ close the fetcher, if it was made here rather than passed in """
+        if self.own_fetcher:
+            self.fetcher.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
 
     def dash_to_0(self, number_string):
         number_string = number_string.strip()
@@ -168,94 +371,102 @@ class Tournament_Scraper:
 
         return start_date, end_date
 
-    def scrape_tournaments_by_year(self, year):
+    def scrape_tournaments_by_year(self, year, incremental=False):
+        """scrape every tournament listed for the year. If incremental is
+        set, only the tournaments that are new, or whose pages have changed,
+        are scraped. A tournament's results can be corrected without its
+        year page changing, so every tournament page is still checked, but
+        with the cache that is usually just a 304"""
         print(f"\n getting tournaments for {year}")
-        year_url = f"{URLBASE}Tournament/Tournaments_{year}.html"
-        year_page = requests.get(year_url)
-        year_soup = BeautifulSoup(year_page.content, "html.parser")
-
-        table_raw = year_soup.findAll(
-            "div", {"class": "Tableau_CertifiedTournament"})
-        if table_raw is not None and len(table_raw) > 0:
-            # iterate over each ruleset
-            # we need to specify whether it's mcr or RCR,
-            # as ids are duplicated between them!!!
-            ruleset = Ruleset.mcr
-            for table in table_raw:
-                tournaments = table.findAll(
-                    "div", {"class": re.compile('TCTT_ligne*')})[2:]
-                for tourney in tournaments:
-                    cells = tourney.find_all("p")
-                    tid = int(cells[0].string)
-                    self.scrape_tournament_by_id(
-                        tid,
-                        countries=cells[6].string,
-                        ruleset=ruleset,
-                        )
-                ruleset = Ruleset.riichi
+        year_page = self.fetcher.get(f"Tournament/Tournaments_{year}.html")
+        listed = parse_year_page(year_page.content)
+
+        # fetch the tournament pages in the background, while we work
+        # through them one by one
+        self.fetcher.prefetch(self.tournament_path(tid, rules)
+                              for tid, rules, _ in listed)
+        for tid, rules, countries in listed:
+            self.scrape_tournament_by_id(
+                tid,
+                countries=countries,
+                ruleset=rules,
+                incremental=incremental,
+                )
 
-    def get_bs4_tournament_page(self, tournament_id, ruleset):
-        """Get the BeautifulSoup4 object for a tournament web page, given
-        its old_id"""
+    @staticmethod
+    def tournament_path(tournament_id, ruleset):
+        """the path of a tournament web page, relative to the site root"""
         prefix = "TR_" if ruleset == Ruleset.mcr else "TR_RCR_"
 
         # if id < 10, then a 2-digit number is used in the URL
         if tournament_id < 10:
             prefix += "0"
-        tournament_url = f"{URLBASE}Tournament/{prefix}{tournament_id}.html"
-        tournament_page = requests.get(tournament_url)
+        return f"Tournament/{prefix}{tournament_id}.html"
+
+    def get_tournament_page(self, tournament_id, ruleset):
+        """Get a tournament web page, given its old_id"""
+        tournament_page = self.fetcher.get(
+            self.tournament_path(tournament_id, ruleset))
         if not tournament_page.ok:
             # not a riichi tournament, so try mcr
-            tournament_url = f"{URLBASE}Tournament/TR_{tournament_id}.html"
-            tournament_page = requests.get(tournament_url)
+            tournament_page = self.fetcher.get(
+                f"Tournament/TR_{tournament_id}.html")
             if not tournament_page.ok:
                 logging.error(f"ERROR failed to find page for tournament {tournament_id}")
+        return tournament_page
 
-        return BeautifulSoup(tournament_page.content, "html.parser")
+    @staticmethod
+    def page_hash(page):
+        """the SHA-256 of a page's content, as the cache has it if it was
+        cached"""
+        return page.hash or hashlib.sha256(page.content).hexdigest()
 
+    def get_bs4_tournament_page(self, tournament_id, ruleset):
+        """Get the BeautifulSoup4 object for a tournament web page, given
+        its old_id"""
+        return BeautifulSoup(
+            self.get_tournament_page(tournament_id, ruleset).content,
+            "html.parser")
 
-    def scrape_tournament_by_id(self, tournament_id, ruleset, countries=None):
+
+    def scrape_tournament_by_id(self, tournament_id, ruleset, countries=None,
+                                rerank=False, incremental=False):
         """given an old tournament_id, scrape the webpage, and create
-        a database item with the metadata. Then scrape the results"""
+        a database item with the metadata. Then scrape the results.
+        If rerank is set, re-rank the players in this tournament afterwards.
+        If incremental is set, do nothing if the page is the same as when
+        we last scraped it"""
 
         t = self.session.query(Tournament).filter_by(
             old_id=tournament_id, ruleset=ruleset).first()
 
         print('.', end='')
+        page = self.get_tournament_page(tournament_id, ruleset)
+        page_hash = self.page_hash(page)
+        if incremental and t is not None and t.page_hash == page_hash:
+            return
+        self.store_tournament(t, tournament_id, ruleset, countries,
+                              parse_tournament_page(page.content), page_hash,
+                              rerank=rerank)
+
+    def store_tournament(self, t, tournament_id, ruleset, countries, info,
+                         page_hash, players=None, rerank=False):
+        """create or update the Tournament, given the dict from
+        parse_tournament_page, then store its results. players, if given,
+        maps ema ids to their parsed player pages, or to futures of them"""
         is_new = t is None
         if is_new:
             t = Tournament()
 
-        tournament_soup = self.get_bs4_tournament_page(tournament_id, ruleset)
-        tournament_info = tournament_soup.findAll("td")
-
-        # get mers weight
-        try:
-            weight_string = tournament_info[12].string.strip().split("(")[0]
-            weight = french_float(weight_string)
-        except:
-            weight = 0
-
-        place = tournament_info[6].text.lstrip().split("(")[0].title()
-        country_string = tournament_info[6].findAll("a")[0]["href"]
-        country_match = country_link_pattern.search(country_string)
-        old3 = "???" if country_match is None else \
-            country_match.group(1)
-        try:
-            flag_string = tournament_info[6].find("img").attrs['src']
-            matches = country_pattern.search(flag_string)
-            iso2 = matches[1]
-        except:
-            iso2 = "??"
-        t.country = self.add_country(old3=old3, iso2=iso2)
+        t.country = self.add_country(old3=info["old3"], iso2=info["iso2"])
 
         # remove ", {country}" from place before putting it into db
         # Behaves nicely, even if there's more than one comma in place
         # As long as the country name doesn't have a comma in it
-        t.place = ", ".join(place.split(",")[0:-1])
+        t.place = ", ".join(info["place"].split(",")[0:-1])
         t.ruleset = ruleset
-        t.raw_date = tournament_info[8].text.strip().title()
-        t.title = tournament_info[4].text.strip().title()
+        t.raw_date = info["raw_date"]
+        t.title = info["title"]
         t.start_date, t.end_date = self.parse_dates(t.raw_date, t.title)
 
         if tournament_id == 269 and t.ruleset == Ruleset.mcr:
@@ -263,7 +474,7 @@ class Tournament_Scraper:
             # for this one tournament VILLEJUIF OPEN 2017 - IN VINO VERITAS I
             t.player_count = 84
         else:
-            t.player_count = int(tournament_info[10].text.strip())
+            t.player_count = int(info["player_count"].strip())
 
         if t.end_date < datetime(2018, 4, 18) or \
                 t.end_date >= datetime(2022, 7, 1):
@@ -282,49 +493,45 @@ class Tournament_Scraper:
 
 
         t.ema_country_count = countries # TODO if this is none, calculate it manually
-        t.mers = weight
+        t.mers = info["weight"]
         t.old_id = tournament_id
         t.scraped_on = datetime.now()
+        t.page_hash = page_hash
 
         if is_new: # add tournament to db if it's new
             self.session.add(t)
         self.session.commit()
 
+        previous_player_ids = [pt.player_id for pt in self.session.query(
+            PlayerTournament).filter_by(tournament=t)]
+
         # scrape results for tournament
-        self.extract_tournament_results_from_page(t, tournament_soup)
+        self.store_results(t, info["results"], players)
 
-    def add_player(self, ema_id):
+        if rerank:
+            PlayerRankingEngine(self.session).rank_tournament_players(
+                t, previous_player_ids)
+
+    def add_player(self, ema_id, info=None):
+        """create or update a Player from their page. info is the dict from
+        parse_player_page, if the page has been parsed already"""
         # if ema_id is zero, create player with blank ema_id
         p = self.session.query(Player).filter_by(ema_id=ema_id).first()
         is_new = p is None
         if is_new:
             p = Player()
-        page = requests.get(f"{URLBASE}Players/{ema_id}.html")
+        if info is None:
+            info = parse_player_page(
+                self.fetcher.get(f"Players/{ema_id}.html").content)
         p.ema_id = ema_id
-        pic = None
-        tables = None
-        try:
-            dom = BeautifulSoup(page.content, "html.parser")
-            tables = dom.findAll(
-                "div", {"class": "contentpaneopen"})[0].findAll("table")
-            rows = tables[0].find_all("tr")
-            p.calling_name = rows[2].find_all("td")[1].string.title()
-            names = p.calling_name.split(" ")
-            p.sorting_name = names[-1] + ", " + "  ".join(names[0:-1])
-            pic = rows[0].find("img").attrs["src"]
-            flag_string = rows[3].find("img").attrs["src"]
-            matches = country_pattern.search(flag_string)
-            iso2 = matches[1]
-            country_string = rows[3].find("a").attrs["href"]
-            country_match = country_link_pattern.search(country_string)
-            old3 = "???" if country_match is None else \
-                country_match.group(1)
-        except:
-            iso2 = "??"
-            old3 = "???"
-        p.country = self.add_country(old3=old3, iso2=iso2)
+        if info["calling_name"] is not None:
+            p.calling_name = info["calling_name"]
+            p.sorting_name = info["sorting_name"]
+        pic = info["pic"]
+        iso2 = info["iso2"]
+        p.country = self.add_country(old3=info["old3"], iso2=iso2)
         try:
-            org = rows[4].findAll("td")[1]
+            org_name, org_url = info["national_org"]
             org = self.db.query(Club).filter(Club.is_the_national_org).filter(
                 Club.country_id == iso2)
             new_org = org is None
@@ -332,8 +539,8 @@ class Tournament_Scraper:
                 org = Club()
                 org.country_id = iso2
                 org.is_the_national_org = True
-                org.name = org.string
-                org.url = org.find("a").attrs['href']
+                org.name = org_name
+                org.url = org_url
                 # TODO logo is on the page
                 # f"/ranking/Country/{old3}_Information.html"
                 # in div.contentpaneopen > table > tbody > tr[0] > td[0] > img.src
@@ -342,11 +549,9 @@ class Tournament_Scraper:
         except:
             pass
         try:
-            org = rows[5].findAll("td")[1]
+            club_name, club_url = info["club"]
             # does this club already exist in the db? if not, create it
-            club_name = org.string
-            club_url = org.find("a").attrs["href"].replace(
-                'http://', 'https://')
+            club_url = club_url.replace('http://', 'https://')
             club = self.db.query(Club).filter_by(name=club_name).first()
             if club is None:
                 club = self.db.query(Club).filter_by(url=club_url).first()
@@ -363,19 +568,10 @@ class Tournament_Scraper:
         except:
             pass
 
-        if ema_id is not None and ema_id != "-1" and tables is not None:
-            # get the official rankings for both rulesets
-            rows = tables[1].find_all("tr")
-            try:
-                rank = french_float(rows[2].find_all("td")[2].text)
-            except:
-                rank = None
-            p.mcr_official_rank = rank
-            try:
-                rank = french_float(rows[3].find_all("td")[2].text)
-            except:
-                rank = None
-            p.riichi_official_rank = rank
+        if ema_id is not None and ema_id != "-1" and info["ranked"]:
+            # the official rankings for both rulesets
+            p.mcr_official_rank = info["mcr_official_rank"]
+            p.riichi_official_rank = info["riichi_official_rank"]
 
         # just guess that the family name is the word after the last space
         p.profile_pic = None if pic == "photo/Vide.jpg" else pic
@@ -386,37 +582,50 @@ class Tournament_Scraper:
     def extract_tournament_results_from_page(self, t, tournament_soup):
         """Enter results for tournament. given the Tournament object
         and BS4 web page"""
+        results_table = tournament_soup.findAll(
+            "div", {"class": "TCTT_lignes"})[0]
+        self.store_results(t, [parse_result_row(result) for result in
+            results_table.findAll(
+                "div", {"class": re.compile('TCTT_ligne*')})[1:]])
+
+    def store_results(self, t, results, players=None):
+        """Enter results for tournament, given the Tournament object and
+        the result rows from parse_tournament_page. New players' pages are
+        looked up in players, if it's given, and fetched otherwise"""
 
         # TODO sometimes there's an image attached to  1st/2nd/3rd that
         #      isn't attached to an individual player acount
 
-        self.session.query(PlayerTournament).filter_by(tournament=t).delete()
-        self.session.commit()
+        # existing results are updated in place, and only the ones no longer
+        # on the page are deleted, so an unchanged row is left alone
+        # rows are flushed as they go, and committed once at the end, as
+        # a commit per row expires everything, and is most of the work
         is_mcr = t.ruleset == Ruleset.mcr
+        seen = set()
 
-        results_table = tournament_soup.findAll(
-            "div", {"class": "TCTT_lignes"})[0]
-        results = results_table.findAll(
-            "div", {"class": re.compile('TCTT_ligne*')})[1:]
         if len(results) != t.player_count:
             logging.error("Discrepancy between number of players "
                 f"({t.player_count}) and number of results ({len(results)}) "
                 f"for {t.title}, {t.ruleset} {t.old_id}")
+
+        if players is None:
+            # fetch the profiles of new players in the background
+            self.fetcher.prefetch(f"Players/{ema_id}.html"
+                                  for ema_id in self.new_players(results))
         rank_errors = 0
         previous_position = 0
         previous_table_points = 0
         previous_score = 0
         for result in results:
-            result_content = result.findAll("p")
-            position = int(self.dash_to_0(result_content[0].text)) or \
+            position = int(self.dash_to_0(result["position"])) or \
                 t.player_count
-            player_id = self.dash_to_0(result_content[1].text)
-            score = int(self.dash_to_0(result_content[6].text))
+            player_id = self.dash_to_0(result["ema_id"])
+            score = int(self.dash_to_0(result["score"]))
 
             # if it's mcr, grab table points too
             if is_mcr:
                 table_points = french_float(self.dash_to_0(
-                    result_content[5].text))
+                    result["table_points"]))
             else:
                 table_points = None
 
@@ -441,8 +650,8 @@ class Tournament_Scraper:
                 # here, we add on the ruleset, the tournament id, and the
                 # ranking position, to ensure that in teh database, this player
                 # is unique, and is attached to *this* tournament only
-                name = result_content[3].string.title() + \
-                    " " + result_content[2].string.title() + \
+                name = result["first_name"].title() + \
+                    " " + result["last_name"].title() + \
                     str(t.ruleset).replace("Ruleset.", " (") + \
                     f"{t.old_id} {position}th)"
                 was_ema = False
@@ -453,10 +662,12 @@ class Tournament_Scraper:
                     p = Player()
                     p.ema_id = "-1"
                     p.calling_name = name
-                    p.sorting_name = result_content[2].string.title() + \
-                        ", " + result_content[3].string.title()
+                    p.sorting_name = result["last_name"].title() + \
+                        ", " + result["first_name"].title()
                     self.session.add(p)
-                    self.session.commit()
+                    self.session.flush()
+                else:
+                    pt = self.session.get(PlayerTournament, (p.id, t.id))
             else:
                 was_ema = True
                 rank = PlayerRankingEngine.calculate_base_rank(t.player_count,
@@ -464,22 +675,25 @@ class Tournament_Scraper:
                 p = self.session.query(Player).filter_by(
                     ema_id=player_id).first()
                 if p is None:
-                    p = self.add_player(player_id)
+                    info = None if players is None else players.get(player_id)
+                    if hasattr(info, "result"):
+                        info = info.result()
+                    p = self.add_player(player_id, info)
                     if p.calling_name is None:
-                        p.calling_name = result_content[3].string.title() + \
-                            " " + result_content[2].string.title()
+                        p.calling_name = result["first_name"].title() + \
+                            " " + result["last_name"].title()
 
-                    p.sorting_name = result_content[2].string.title() + \
-                        ", " + result_content[3].string.title()
+                    p.sorting_name = result["last_name"].title() + \
+                        ", " + result["first_name"].title()
 
-                    self.session.commit()
+                    self.session.flush()
                 else:
                     # check whether we've already got this score
                     pt = self.session.query(PlayerTournament).filter_by(
                         tournament_id=t.id, player_id=p.id).first()
 
             # check our base_rank calculation with the official one, log any discrepancies
-            official_rank = int(self.dash_to_0(result_content[7].text))
+            official_rank = int(self.dash_to_0(result["official_rank"]))
             if rank != official_rank:
                 rank_errors += 1
                 logging.error(
@@ -506,11 +720,32 @@ class Tournament_Scraper:
             pt.country_id = cid
             if is_new:
                 self.session.add(pt)
-            self.session.commit()
+            self.session.flush()
+
+            seen.add(p.id)
+
+        # remove results that are no longer on the page
+        self.session.query(PlayerTournament).filter_by(tournament=t).filter(
+            PlayerTournament.player_id.not_in(seen)).delete(
+            synchronize_session=False)
+        self.session.commit()
 
         if rank_errors > 0:
             print(f"{rank_errors} base-rank discrepancies for {t.title}; logfile has details")
 
-    def scrape_all(self, start:int=2005, end:int=2025):
+    def new_players(self, results) -> list:
+        """the ema ids in the results that aren't in the database yet"""
+        ema_ids = {self.dash_to_0(result["ema_id"])
+                   for result in results} - {"0"}
+        known = {p[0] for p in self.session.query(Player.ema_id).filter(
+            Player.ema_id.in_(ema_ids))}
+        return sorted(ema_ids - known)
+
+    def scrape_all(self, start:int=2005, end:int=2025, incremental=False):
+        """scrape every year. With incremental set, only the tournaments
+        that are new or changed since the last scrape are touched, e.g. for
+        a nightly sync"""
+        self.fetcher.prefetch(f"Tournament/Tournaments_{year}.html"
+                              for year in range(start, end))
         for year in list(range(start, end)):
-            self.scrape_tournaments_by_year(year)
+            self.scrape_tournaments_by_year(year, incremental)